@@ -0,0 +1,67 @@
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+import inten
+
+
+def parse_levels(text):
+    if text == 'none':
+        return ()
+    if text == 'all':
+        return True
+    return [int(level) for level in text.split(',')]
+
+
+def run(args, levels):
+    '''Returns seconds per training step and peak memory, measured in a fresh process'''
+    device = torch.device(args.device)
+    model = inten.squeezeseg.SqueezeWithHead.load_from_kwargs(
+        {
+            'head_cls': 'L2ReflectHead',
+            'squeeze_kwargs': {'input_channels': 2, 'squeeze_depth': args.depth, 'cam_depth': 1, 'checkpoint_levels': levels},
+            'head_kwargs': {'in_channels': 64, 'mid_channels': 32},
+        }
+    ).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), 0.01)
+    data = torch.rand(args.batch, 2, args.height, args.width, device=device)
+    target = torch.rand(args.batch, 1, args.height, args.width, device=device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for step in range(args.steps + 1):
+        if step == 1:  # First step warms up
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        (pred,) = model(data)
+        torch.nn.functional.mse_loss(pred, target).backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return (time.perf_counter() - start) / args.steps, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory and speed of training steps with activation recomputation')
+    parser.add_argument('-l', '--levels', nargs='+', default=['none', '0', '0,1', 'all'], help='Recomputed levels, comma separated, none or all')
+    parser.add_argument('-b', '--batch', type=int, default=4)
+    parser.add_argument('-H', '--height', type=int, default=64)
+    parser.add_argument('-W', '--width', type=int, default=512)
+    parser.add_argument('-d', '--depth', type=int, default=3, help='squeeze_depth of the model')
+    parser.add_argument('-s', '--steps', type=int, default=3)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    memory = 'allocated' if torch.device(args.device).type == 'cuda' else 'max rss'
+    print(f'Batch {args.batch}x2x{args.height}x{args.width}, squeeze_depth {args.depth}, device {args.device}')
+    print(f'{"levels":>10}\t{"s/step":>8}\t{"peak " + memory + " [MiB]":>22}')
+    for text in args.levels:
+        with mp.get_context('spawn').Pool(1) as pool:
+            seconds, peak = pool.apply(run, (args, parse_levels(text)))
+        print(f'{text:>10}\t{seconds:8.3f}\t{peak / 2 ** 20:22.1f}')
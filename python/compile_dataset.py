@@ -0,0 +1,11 @@
+import sys
+
+import inten
+import otils as ot
+
+if __name__ == '__main__':
+    config = ot.io.load_multi_yml(sys.argv[1])
+    for part in ['train', 'val']:
+        if part in config:
+            dataset = inten.data.Dataset(config[part])
+            print(f'Compiling {len(dataset)} files of {dataset.name} to {dataset.compile()}')
@@ -45,13 +45,15 @@ def parse_args():
     parser = argparse.ArgumentParser('Create velodyne data')
     parser.add_argument('in_dir', help='Dataset directory. The directory shoud have a structure {in_dir}/orig/orig-{json,rgb,depth,stencil}')
     parser.add_argument('-np', '--num_processes', default=mp.cpu_count() // 2, type=int, help='Number of processes to use')
+    parser.add_argument('-s', '--shards', default=False, action='store_true', help='Whether original data are packed in scene shards')
     parser.add_argument('-dt', '--delete_tmp', default=False, action='store_true', help='Whether to delete temporary files')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     parsed = parse_args()
-    dataset = datatools.gta.GTADataset(parsed.in_dir, width=4)
+    base = datatools.gta.GTAShardEntry if parsed.shards else datatools.gta.GTAEntry
+    dataset = datatools.gta.GTADataset(parsed.in_dir, base=base, width=4)
     f = functools.partial(access, data=dataset, del_data=parsed.delete_tmp)
     with mp.Pool(parsed.num_processes) as pool:
         pool.map(f, range(0, len(dataset), 4))
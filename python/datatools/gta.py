@@ -1,7 +1,9 @@
 import enum
 import functools
 import glob
+import io
 import itertools as it
+import json
 import os.path as osp
 import warnings
 
@@ -73,6 +75,17 @@ def _stencil_loader(filename):
     return ot.io.img_load(filename, 'u1', 'u1', 1) & 7
 
 
+SHARD_PATH = ('orig', 'orig-shards')
+
+
+def _shard_loader(kind, decode):
+    def load(fname):
+        dirname, data_id = osp.split(fname)
+        return decode(io.BytesIO(ot.io.shard_reader(dirname).read(int(data_id), kind)))
+
+    return load
+
+
 @attr.s
 class GTAEntry(ot.dataset.DatasetEntry):
     STENCIL_COLORS = npa(
@@ -272,8 +285,21 @@ class GTAEntry(ot.dataset.DatasetEntry):
     )
 
 
+@attr.s
+class GTAShardEntry(GTAEntry):
+    '''Entry reading original data from scene shards created by prepare_dataset.py with output_format shards'''
+
+    rgb = ot.dataset.DataAttrib('{data_id}', _shard_loader('rgb', ot.io.img_load), SHARD_PATH, deletable=False)
+    depth = ot.dataset.DataAttrib('{data_id}', _shard_loader('depth', _depth_loader), SHARD_PATH, deletable=False)
+    stencil = ot.dataset.DataAttrib('{data_id}', _shard_loader('stencil', _stencil_loader), SHARD_PATH, deletable=False)
+    meta = ot.dataset.DataAttrib('{data_id}', _shard_loader('meta', json.load), SHARD_PATH, wfable=False, deletable=False)
+
+
 class GTADataset(ot.dataset.Dataset):
     def __init__(self, base_dir, bbox=(130, 130, 130), base=GTAEntry, **kwargs):
-        num_files = ot.dataset.NumFiles(num_files=len(glob.glob(osp.join(base_dir, 'orig', 'orig-json', '*.json'))))
+        if issubclass(base, GTAShardEntry):
+            num_files = ot.dataset.NumFiles(num_files=len(ot.io.shard_reader(osp.join(base_dir, *SHARD_PATH))))
+        else:
+            num_files = ot.dataset.NumFiles(num_files=len(glob.glob(osp.join(base_dir, 'orig', 'orig-json', '*.json'))))
         kwargs['bbox'] = bbox
         super().__init__(base_dir, num_files, base, entry_kwargs=kwargs)
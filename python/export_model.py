@@ -0,0 +1,72 @@
+import argparse
+import glob
+import os.path as osp
+import time
+
+import numpy as np
+import torch
+
+import inten
+import otils as ot
+
+
+def load_grids(args, channels):
+    '''Batches of grids cropped to the exported width, random ones without a grid folder'''
+    if args.grids is None:
+        return [torch.rand(args.batch, channels, args.height, args.width) for _ in range(args.batches)]
+    dataset = inten.infer.GridFolder(sorted(glob.glob(osp.join(args.grids, '*.npy')))[: args.batch * args.batches])
+    start = args.start
+    batches = []
+    for i in range(0, len(dataset) - args.batch + 1, args.batch):
+        batch = torch.stack([dataset[j]['data'] for j in range(i, i + args.batch)])
+        if start is None:
+            start = (batch.shape[-1] - args.width) // 2
+        batches.append(batch[:, :, : args.height, start : start + args.width])
+    return batches
+
+
+def latency(model, batches, repeats):
+    '''Milliseconds per batch over all repeats of batches, after one warm up pass'''
+    times = []
+    with torch.inference_mode():
+        model(batches[0])
+        for _ in range(repeats):
+            for batch in batches:
+                start = time.perf_counter()
+                model(batch)
+                times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a model for grids of a fixed width and compares its latency with the eager model')
+    parser.add_argument('config', help='Config of the model')
+    parser.add_argument('output', help='Exported model, .pt for TorchScript or .onnx for ONNX')
+    parser.add_argument('-w', '--weights', default=None, help='State dict (.pt) or checkpoint of the model, random weights if not given')
+    parser.add_argument('-W', '--width', type=int, default=512, help='Columns of the grids, e.g. 512 for only_mid or 2084 for full scans')
+    parser.add_argument('-H', '--height', type=int, default=64)
+    parser.add_argument('--start', type=int, default=None, help='First column of the crop of the grids, centered if not given')
+    parser.add_argument('--no-fuse', action='store_true', help='Keep batch normalizations in the exported model')
+    parser.add_argument('-g', '--grids', default=None, help='Folder with grid lidar sweeps for the benchmark, random grids if not given')
+    parser.add_argument('-b', '--batch', type=int, default=1)
+    parser.add_argument('-n', '--batches', type=int, default=4, help='Batches in the benchmark, 0 only exports the model')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    config = ot.io.load_multi_yml(args.config)
+    channels = config['model']['squeeze_kwargs']['input_channels']
+    if args.weights is not None:
+        model = inten.infer.load_model(config, args.weights, 'cpu')
+    else:
+        model = inten.squeezeseg.SqueezeWithHead.load_from_kwargs(config['model']).eval()
+    inten.export.export_model(model, args.output, channels, args.height, args.width, fuse=not args.no_fuse)
+    print(f'Model for {channels}x{args.height}x{args.width} grids exported to {args.output}')
+    if args.batches:
+        exported = inten.export.load_exported(args.output)
+        batches = load_grids(args, channels)
+        error = max((eager - other).abs().max().item() for batch in batches for eager, other in zip(model(batch), exported(batch)))
+        print(f'Max difference of outputs: {error:.3g}')
+        print(f'{"model":>10}\t{"median [ms]":>12}\t{"p90 [ms]":>10}\t{"grids/s":>8}')
+        for name, runnable in (('eager', model), (inten.export.export_format(args.output), exported)):
+            times = latency(runnable, batches, args.repeats)
+            print(f'{name:>10}\t{np.median(times):12.1f}\t{np.percentile(times, 90):10.1f}\t{1000 * args.batch / times.mean():8.2f}')
@@ -1 +1 @@
-from . import db, gta_math, io, query  # noqa: F401
+from . import cleanup, db, gta_math, io, query  # noqa: F401
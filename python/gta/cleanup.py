@@ -0,0 +1,122 @@
+import concurrent.futures as cf
+import os
+import queue
+import threading
+
+import attr
+import psycopg2
+
+from . import io, query
+
+
+@attr.s
+class PendingDeletes:
+    '''Deletions of original snapshots collected inside an export worker, deduplicated by snapshot id'''
+
+    snapshots = attr.ib(factory=dict)
+
+    def add(self, snapshots):
+        for snapshot in snapshots:
+            self.snapshots[snapshot.snapshot_id] = snapshot.imagepath
+
+    def drain(self):
+        result = list(self.snapshots.items())
+        self.snapshots.clear()
+        return result
+
+
+def _remove(fname):
+    try:
+        os.remove(fname)
+    except OSError as e:
+        return e
+    return None
+
+
+class Cleanup:
+    '''
+    Background stage deleting original snapshots reported by export workers.
+    Rows are deleted in batches on a dedicated connection and every batch is committed before its files are removed,
+    so a failing batch is rolled back with both its rows and files kept, and the export can be run again.
+    An error stopping the stage, e.g. a failed connection, is raised again by close, or on leaving the context, unless
+    the context is left by another exception, which is then kept and the error of the stage is only printed.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.queue = queue.Queue()
+        self.pending = dict()
+        self.done = set()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, items):
+        self.queue.put(items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self.stop()
+        if self.error is not None:
+            print(f'Cleanup of original snapshots failed, remaining ones were kept! Error was: {self.error!r}')
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+        if self.error is not None:
+            raise RuntimeError('Cleanup of original snapshots failed, remaining ones were kept!') from self.error
+
+    def _run(self):
+        try:
+            self._cleanup()
+        except BaseException as e:  # pylint: disable=broad-except
+            self.error = e
+
+    def _cleanup(self):
+        conn = None if self.args.cleanup_dry_run else psycopg2.connect(dsn=self.args.conn_string)
+        try:
+            with cf.ThreadPoolExecutor(self.args.cleanup_threads) as pool:
+                while True:
+                    items = self.queue.get()
+                    if items is None:
+                        break
+                    for snapshot_id, imagepath in items:
+                        if snapshot_id not in self.done:
+                            self.pending[snapshot_id] = imagepath
+                    if len(self.pending) >= self.args.cleanup_batch:
+                        self._flush(conn, pool)
+                self._flush(conn, pool)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _flush(self, conn, pool):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, dict()
+        self.done.update(batch)
+        fnames = [os.path.join(self.args.in_dir, imagepath + suffix) for imagepath in batch.values() for suffix in io.SUFFICES.values()]
+        if self.args.cleanup_dry_run:
+            print(f'Would delete {len(batch)} snapshots and {len(fnames)} files')
+            if self.args.verbose:
+                print('\n'.join(fnames))
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query.DELETE_SNAPSHOTS, (list(batch),))
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f'Failed to delete {len(batch)} snapshots from database, keeping their files! Error was: {e}')
+            return
+        for fname, error in zip(fnames, pool.map(_remove, fnames)):
+            if error is not None and self.args.verbose:
+                print(f'Failed to remove file {fname}! Error was: {error}')
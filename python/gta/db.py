@@ -6,7 +6,7 @@ import numpy as np
 import psycopg2
 import psycopg2.extras
 
-from . import io, query
+from . import cleanup, io, query
 
 
 def failed_result(snapshots, dataitems, index, args):
@@ -43,9 +43,16 @@ def process_snapshot(snapshot, prev, img_id, args):
     return True, dataitem
 
 
-def process_scene(img_id, scene_id):
+def process_scene(scene_idx, scene_id):
     args = globals()['args']
-    img_id = img_id * args.num_cameras
+    written = export_scene(scene_idx, scene_id, args)
+    deletes = args.pending_deletes.drain()
+    return deletes if written else []
+
+
+def export_scene(scene_idx, scene_id, args):
+    '''Returns False, when outputs of the scene could not be written, so none of its snapshots may be deleted'''
+    img_id = scene_idx * args.num_cameras
     args.cursor.execute(query.SNAPSHOTS, (args.current_run_id, scene_id))
     snapshots = args.cursor.fetchall()
     if len(snapshots) != args.num_cameras:
@@ -54,7 +61,7 @@ def process_scene(img_id, scene_id):
         if args.verbose:
             print('There are not enough snapshots for the scene!')
         if args.needs_all:
-            return
+            return True
     dataitems = []
     prev = None
     for i, snapshot in enumerate(snapshots):
@@ -62,17 +69,34 @@ def process_scene(img_id, scene_id):
         if not result:
             failed_result(snapshots, None, i, args)
             if args.needs_all:
-                return
+                return True
             continue
         dataitems.append(prev)
 
+    args.shard = io.SceneShard(args, scene_idx) if args.output_format == 'shards' else None
+    written = []
     for i, dataitem in enumerate(dataitems):
         result = dataitem.save_snapshot(args)
         if not result:
             failed_result(snapshots, dataitems, i, args)
             if args.needs_all:
-                return
+                if args.shard is not None:
+                    args.shard.abort()
+                return True
             continue
+        written.append(dataitem)
+    if args.shard is None:
+        return True
+    if not args.shard.close():
+        print(f'Failed to write shard of scene {scene_idx}, keeping its original snapshots!')
+        return False
+    if args.delete_originals:
+        io.delete_orig_files([dataitem.snapshot_data for dataitem in written], args)
+    return True
+
+
+def process_scene_star(scene):
+    return process_scene(*scene)
 
 
 def get_runs(args):
@@ -113,17 +137,23 @@ def process_run(run_id, args):
     # ugliness due to multiprocess
     cursor, conn = args.cursor, args.conn
     del args.cursor, args.conn
+    args.pending_deletes = cleanup.PendingDeletes()
     no_conn_args = copy.deepcopy(args)
-    args.cursor, args.conn = cursor, conn
+    args.cursor, args.conn, args.pending_deletes = cursor, conn, None
 
-    with mp.Pool(args.num_processes, initializer=open_connection, initargs=(no_conn_args, True)) as pool:
-        pool.starmap(process_scene, enumerate(scene_ids))
-        pool.map(close_conn_mp, range(args.num_processes), 1)
+    with cleanup.Cleanup(args) as cleaner:  # Errors of the export are not replaced by errors of the cleanup
+        with mp.Pool(args.num_processes, initializer=open_connection, initargs=(no_conn_args, True)) as pool:
+            for deletes in pool.imap_unordered(process_scene_star, enumerate(scene_ids)):
+                cleaner.add(deletes)
+            pool.map(close_conn_mp, range(args.num_processes), 1)
     num_files = io.rearrange_files(args)
     if reset:
         args.num_cameras = None
     if (num_files == 0 and args.delete_invalid) or args.delete_originals:
-        args.cursor.execute(query.DELETE_RUN, (run_id,))
+        if args.cleanup_dry_run:
+            print(f'Would delete run {run_id}')
+        else:
+            args.cursor.execute(query.DELETE_RUN, (run_id,))
 
 
 def get_scene_ids(cursor, run_id):
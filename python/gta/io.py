@@ -1,8 +1,10 @@
 import glob
+import io
 import json
 import math
 import os
 import re
+import tarfile as tf
 
 import attr
 import numpy as np
@@ -20,21 +22,37 @@ def json_save(data, fname):
         json.dump(data, f)
 
 
+def img_bytes(data):
+    buf = io.BytesIO()
+    Image.fromarray(data).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def json_bytes(data):
+    return json.dumps(data).encode('utf-8')
+
+
 SUFFICES = {'rgb': '.tiff', 'depth': '-depth.tiff', 'stencil': '-stencil.tiff'}
 
 OUT_DIRS = ['orig-rgb', 'orig-depth', 'orig-stencil', 'orig-json']
 OUT_SUFFICES = ['.png', '.png', '.png', '.json']
 OUT_ATTRS = ['rgb', 'depth', 'stencil', 'meta']
 OUT_SAVERS = [img_save, img_save, img_save, json_save]
+OUT_ENCODERS = [img_bytes, img_bytes, img_bytes, json_bytes]
 
-LOG_REGEX = r"""^.+[cC]omputed.+position.+:\s+(?P<comp_pos>X:-?[0-9]+(\.[0-9]+)?\ Y:-?[0-9]+(\.[0-9]+)?\ Z:-?[0-9]+(\.[0-9]+)?)$\n
-^.+[nN]ew.+position.+:\s+(?P<rep_pos>X:-?[0-9]+(\.[0-9]+)?\ Y:-?[0-9]+(\.[0-9]+)?\ Z:-?[0-9]+(\.[0-9]+)?)$\n
-^.+[cC]omputed.+rotation.+:\s+(?P<comp_rot>X:-?[0-9]+(\.[0-9]+)?\ Y:-?[0-9]+(\.[0-9]+)?\ Z:-?[0-9]+(\.[0-9]+)?)$\n
-^.+[nN]ew.+rotation.+:\s+(?P<rep_rot>X:-?[0-9]+(\.[0-9]+)?\ Y:-?[0-9]+(\.[0-9]+)?\ Z:-?[0-9]+(\.[0-9]+)?)$\n
-(^.+$\n)+? # one more line
-^.+(?P<file_name>[0-9]{4}-[0-9]{2}-[0-9]{2}--[0-9]{2}-[0-9]{2}-[0-9]{2}--[0-9]{3})$"""
+SHARD_DIR = 'orig-shards'
+SHARD_INDEX = 'index.json'
 
-LOG_PATTERN = re.compile(LOG_REGEX, re.VERBOSE | re.MULTILINE)
+_LOG_XYZ = r'(X:-?[0-9]+(\.[0-9]+)?\ Y:-?[0-9]+(\.[0-9]+)?\ Z:-?[0-9]+(\.[0-9]+)?)$'
+LOG_LINE_PATTERNS = [
+    ('comp_pos', re.compile(r'^.+[cC]omputed.+position.+:\s+' + _LOG_XYZ)),
+    ('rep_pos', re.compile(r'^.+[nN]ew.+position.+:\s+' + _LOG_XYZ)),
+    ('comp_rot', re.compile(r'^.+[cC]omputed.+rotation.+:\s+' + _LOG_XYZ)),
+    ('rep_rot', re.compile(r'^.+[nN]ew.+rotation.+:\s+' + _LOG_XYZ)),
+]
+LOG_FILE_PATTERN = re.compile(r'^.+([0-9]{4}-[0-9]{2}-[0-9]{2}--[0-9]{2}-[0-9]{2}-[0-9]{2}--[0-9]{3})$')
+LOG_INDEX_SUFFIX = '.index.npy'
+LOG_INDEX_DTYPE = np.dtype([('name', 'S25')] + [(key, '<f8', (3,)) for key, _ in LOG_LINE_PATTERNS])
 
 
 @attr.s
@@ -103,6 +121,8 @@ class Snapshot:
         return True
 
     def save_snapshot(self, args):
+        if args.output_format == 'shards':
+            return self.save_snapshot_shard(args)
         file_base = os.path.join(args.output_dir, f'{args.current_run_id}', 'orig', '{dir_kind}', f'{self.img_id:0{args.format_width}d}' + '{suf}')
         for d, suf, att, save in zip(OUT_DIRS, OUT_SUFFICES, OUT_ATTRS, OUT_SAVERS):
             fname = file_base.format(dir_kind=d, suf=suf)
@@ -118,6 +138,71 @@ class Snapshot:
             delete_orig_files([self.snapshot_data], args)
         return True
 
+    def save_snapshot_shard(self, args):
+        for suf, att, encode in zip(OUT_SUFFICES, OUT_ATTRS, OUT_ENCODERS):
+            try:
+                args.shard.add(self.img_id, att, suf, encode(getattr(self, att)))
+            except (OSError, ValueError, TypeError) as e:
+                if args.verbose:
+                    print(f'Failed to encode {att} of image {self.img_id}! Error was: {e}')
+                return False
+        return True  # Originals are deleted by export_scene only once the shard is written
+
+
+@attr.s
+class SceneShard:
+    '''
+    Packs all snapshots of one scene into a single uncompressed tar accompanied by a json index of member offsets,
+    so that readers can fetch any attribute with one positioned read instead of opening a file per attribute.
+    Members are kept in memory until close, which allows to discard snapshots of a failed scene.
+    '''
+
+    args = attr.ib()
+    shard_id = attr.ib()
+    members = attr.ib(init=False, factory=dict)
+
+    @property
+    def fname(self):
+        return os.path.join(self.args.output_dir, f'{self.args.current_run_id}', 'orig', SHARD_DIR, f'{self.shard_id:0{self.args.format_width}d}.tar')
+
+    def add(self, img_id, att, suf, data):
+        self.members[(img_id, att)] = (f'{att}/{img_id:0{self.args.format_width}d}{suf}', data)
+
+    def discard(self, img_id):
+        for att in OUT_ATTRS:
+            self.members.pop((img_id, att), None)
+
+    def abort(self):
+        '''Drops all members, nothing is written for the scene'''
+        self.members.clear()
+
+    def close(self):
+        if not self.members:
+            return True
+        fname = self.fname
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with tf.open(fname, 'w') as tarf:
+                for arcname, data in self.members.values():
+                    tinfo = tf.TarInfo(arcname)
+                    tinfo.size = len(data)
+                    tarf.addfile(tinfo, io.BytesIO(data))
+            offsets = dict()
+            with tf.open(fname, 'r') as tarf:
+                for member in tarf.getmembers():
+                    offsets[member.name] = [member.offset_data, member.size]
+            index = dict()
+            for (img_id, att), (arcname, _) in self.members.items():
+                index.setdefault(str(img_id), dict())[att] = offsets[arcname]
+            json_save(index, os.path.splitext(fname)[0] + '.json')
+        except OSError as e:
+            if self.args.verbose:
+                print(f'Failed to save shard {fname}! Error was: {e}')
+            return False
+        finally:
+            self.members.clear()
+        return True
+
 
 def process_entity(entity):
     entity = entity._asdict()  # pylint: disable=protected-access
@@ -127,8 +212,11 @@ def process_entity(entity):
 
 
 def delete_orig_files(snapshots, args):
+    if args.pending_deletes is not None:  # Deferred to the cleanup stage
+        args.pending_deletes.add(snapshots)
+        return
+    args.cursor.execute(query.DELETE_SNAPSHOTS, ([snapshot.snapshot_id for snapshot in snapshots],))
     for snapshot in snapshots:
-        args.cursor.execute(query.DELETE_SNAPSHOT, (snapshot.snapshot_id,))
         file_base = os.path.join(args.in_dir, snapshot.imagepath)
         for suffix in SUFFICES.values():
             try:
@@ -139,6 +227,10 @@ def delete_orig_files(snapshots, args):
 
 
 def delete_created_files(dataitems, args):
+    if args.output_format == 'shards':
+        for dataitem in dataitems:
+            args.shard.discard(dataitem.img_id)
+        return
     for dataitem in dataitems:
         file_base = os.path.join(
             args.output_dir, f'{args.current_run_id}', 'orig', '{dir_kind}', f'{dataitem.img_id:0{args.format_width}d}' + '{suf}'
@@ -152,26 +244,115 @@ def delete_created_files(dataitems, args):
                     print(f'Failed to remove file {fname}! Error was: {e}')
 
 
+def parse_log_lines(lines):
+    '''
+    Streaming equivalent of matching the whole log against the multiline pattern:
+    four pose lines, at least one arbitrary line and a line ending with the image name.
+    Yields tuples (name, comp_pos, rep_pos, comp_rot, rep_rot).
+    '''
+    state = 0
+    values = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if state < len(LOG_LINE_PATTERNS):
+            match = LOG_LINE_PATTERNS[state][1].match(line)
+            if match is None and state > 0:
+                state, values = 0, []
+                match = LOG_LINE_PATTERNS[0][1].match(line)
+            if match is not None:
+                values.append([float(x[2:]) for x in match.group(1).split()])
+                state += 1
+            continue
+        if not line:
+            state, values = 0, []
+            continue
+        if state == len(LOG_LINE_PATTERNS):  # one more line
+            state += 1
+            continue
+        match = LOG_FILE_PATTERN.match(line)
+        if match is not None:
+            yield (match.group(1), *values)
+            state, values = 0, []
+
+
+class LogIndex:
+    '''
+    Sorted on-disk array of computed and reported poses keyed by image name, memory mapped on first lookup.
+    Pickles only its filename, so it is cheap to pass to worker processes.
+    '''
+
+    def __init__(self, fname, data=None):
+        self.fname = fname
+        self._data = data
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                self._data = np.load(self.fname, mmap_mode='r')
+            except ValueError:  # Empty arrays cannot be memory mapped
+                self._data = np.load(self.fname)
+        return self._data
+
+    def __getstate__(self):
+        return {'fname': self.fname, '_data': None if self.fname is not None else self._data}
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        key = key.encode('utf-8')
+        names = self.data['name']
+        pos = np.searchsorted(names, key)
+        if pos >= len(names) or names[pos] != key:
+            return default
+        item = self.data[pos]
+        return {name: np.array(item[name]) for name, _ in LOG_LINE_PATTERNS}
+
+    @classmethod
+    def build(cls, log_file, fname=None):
+        names = []
+        poses = []
+        with open(log_file, 'rt', encoding='utf-8') as f:
+            for name, *pose in parse_log_lines(f):
+                names.append(name)
+                poses.append(pose)
+        data = np.empty(len(names), dtype=LOG_INDEX_DTYPE)
+        data['name'] = names
+        if poses:
+            poses = np.array(poses)
+            for i, (key, _) in enumerate(LOG_LINE_PATTERNS):
+                data[key] = poses[:, i]
+        _, last = np.unique(data['name'][::-1], return_index=True)  # Later entries overwrite earlier ones
+        data = data[len(data) - 1 - last]
+        if fname is not None:
+            try:
+                np.save(fname, data)
+            except OSError:  # Keep the index in memory only
+                fname = None
+        return cls(fname, data)
+
+
 def load_log_file(args):
+    index_file = args.log_file + LOG_INDEX_SUFFIX
+    try:
+        if os.path.getmtime(index_file) >= os.path.getmtime(args.log_file):
+            if args.verbose:
+                print(f'Reusing log index {index_file}')
+            return LogIndex(index_file)
+    except OSError:
+        pass
     try:
-        with open(args.log_file, 'rt', encoding='utf-8') as f:
-            logged_data = f.read()
+        return LogIndex.build(args.log_file, index_file)
     except OSError as e:
         if args.verbose:
             print(f'Failed to load log file! The error is {e}')
         return dict()
-    result = dict()
-
-    for match in LOG_PATTERN.finditer(logged_data):
-        matchdict = match.groupdict()
-        filename = matchdict.pop('file_name')
-        for key, val in matchdict.items():
-            matchdict[key] = np.array(list(map(lambda x: float(x[2:]), val.split())))
-        result[filename] = matchdict
-    return result
 
 
 def rearrange_files(args):
+    if args.output_format == 'shards':
+        return rearrange_shards(args)
     file_base_search = os.path.join(args.output_dir, f'{args.current_run_id}', 'orig', '{dir_kind}', '*{suf}')
     last_len = None
     for d, s in zip(OUT_DIRS, OUT_SUFFICES):
@@ -190,3 +371,21 @@ def rearrange_files(args):
         for i, fname in enumerate(files):
             os.rename(fname, file_rename.format(i))
     return last_len
+
+
+def rearrange_shards(args):
+    shard_dir = os.path.join(args.output_dir, f'{args.current_run_id}', 'orig', SHARD_DIR)
+    index = []
+    for fname in sorted(glob.glob(os.path.join(shard_dir, '*.tar'))):
+        try:
+            with open(os.path.splitext(fname)[0] + '.json', 'rt', encoding='utf-8') as f:
+                shard_index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Failed to load index of shard {fname}! I strongly suggest to remove this result and investigate! Error was: {e}')
+            continue
+        for img_id in sorted(shard_index, key=int):
+            index.append([os.path.basename(fname), shard_index[img_id]])
+    args.format_width = math.ceil(math.log10(len(index) + 1))
+    if index:
+        json_save(index, os.path.join(shard_dir, SHARD_INDEX))
+    return len(index)
@@ -14,6 +14,7 @@ SNAPSHOTS = """SELECT snapshot_id, imagepath, cam_near_clip, camera_fov, width,
       ORDER BY timestamp ASC"""
 
 DELETE_SNAPSHOT = """DELETE FROM snapshots WHERE snapshot_id = %s"""
+DELETE_SNAPSHOTS = """DELETE FROM snapshots WHERE snapshot_id = ANY(%s)"""
 DELETE_RUN = """DELETE FROM runs WHERE run_id = %s"""
 
 RUNS = """SELECT run_id FROM runs ORDER BY created ASC"""
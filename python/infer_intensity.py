@@ -1,47 +1,47 @@
-import torch
-import sys
-import numpy as np
-import os
-import glob
-import pickle
-
-if __name__ == "__main__":
-    # State source folder containing grid lidar sweeps
-    grid_folder = sys.argv[1]
-    # State output folder
-    output_folder = sys.argv[2]
-
-
-    grid = glob.glob(f'{grid_folder}/*.npy')
-    import otils
-    import inten
-    config = otils.io.load_multi_yml('../configs/eval.reflect-l2.depth.rgb.yml')
-    config['device'] = 'cpu'
-    runner = inten.data.EvalRunner(config)
-
-    weights = torch.load('intensity_weights.pt')
-
-    runner.model.load_state_dict(weights)
-
-    for file in grid:
-        with torch.no_grad():
-            x = np.load(file)
-
-            ### Data reshaping to get input for neural network
-            data = torch.tensor(x, dtype=torch.float).permute(2,0,1).unsqueeze(0)
-            input_data = data[:,[0, 5,6,7, 8, 9]]
-            input_data[0,0] = input_data[0,0] / 131
-            inten = runner.model(input_data)
-            reflect = inten[0].permute(2, 3, 0, 1).reshape(-1, 1)[:,0]
-            pcl = x.reshape(-1, 11)
-            pcl = np.insert(pcl, 4, reflect, 1)
-
-            destination = f'{output_folder}/{os.path.basename(file)}'
-            np.save(destination, pcl)
-            print(f'{file} stored to {destination} in form of Point cloud')
-
-
-    ''' Resulting point cloud channels: Depth, x-coor, y-coor, z-coor, Reflectivity, Label, Red, Green, Blue, Colour_mask, Returned_ray_mask'''
-
-    # import pptk
-    # v= pptk.viewer(pcl[:,1:4], pcl[:, 4])
+import argparse
+
+import inten
+import otils as ot
+import torchutils as tu
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transforms lidar sweep grids into point clouds with learned intensity')
+    parser.add_argument('grid_folder', help='Folder with grid lidar sweeps')
+    parser.add_argument('output_folder', help='Folder, where point clouds with intensity are stored')
+    parser.add_argument('-c', '--config', default='../configs/eval.reflect-l2.depth.rgb.yml', help='Config of the model')
+    parser.add_argument('-w', '--weights', default='intensity_weights.pt', help='State dict (.pt) or checkpoint of the model')
+    parser.add_argument('-e', '--exported', default=None, help='Model stored by export_model.py, used instead of config and weights')
+    parser.add_argument('-b', '--batch-size', type=int, default=8)
+    parser.add_argument('-j', '--workers', type=int, default=2, help='Processes loading grids')
+    parser.add_argument('--writers', type=int, default=2, help='Threads storing point clouds')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--amp', choices=sorted(tu.AMP_DTYPES), default=None, help='Mixed precision of the forward pass')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--fuse', action='store_true', help='Fold batch normalizations into convolutions')
+    parser.add_argument('-t', '--tile-width', type=int, default=None, help='Runs the model on windows of this many columns, e.g. 512')
+    parser.add_argument('--tile-overlap', type=int, default=64, help='Columns shared by neighbouring windows, blended in the output')
+    parser.add_argument('--tiles-per-batch', type=int, default=8, help='Windows in a forward pass')
+    parser.add_argument('--no-cyclic', action='store_true', help='Grids are not full 360 degree scans, windows do not wrap around')
+    parser.add_argument('--overwrite', action='store_true', help='Process again grids with stored point clouds')
+    parser.add_argument('--log-interval', type=int, default=10, help='Batches between reports of speed')
+    args = parser.parse_args()
+    if args.exported is not None:
+        model = inten.export.load_exported(args.exported, args.device)
+    else:
+        model = inten.infer.load_model(ot.io.load_multi_yml(args.config), args.weights, args.device, args.fuse)
+    if args.tile_width is not None:
+        model = inten.infer.TiledModel(model, args.tile_width, args.tile_overlap, args.tiles_per_batch, not args.no_cyclic)
+    inten.infer.infer_folder(
+        model,
+        args.grid_folder,
+        args.output_folder,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        writers=args.writers,
+        device=args.device,
+        amp=args.amp,
+        channels_last=args.channels_last,
+        overwrite=args.overwrite,
+        log_interval=args.log_interval,
+    )
+    # Resulting point cloud channels: Depth, X, Y, Z, Intensity, Label, Red, Green, Blue, Color_mask, Returned_ray_mask
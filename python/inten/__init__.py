@@ -1 +1 @@
-from . import data, heads, modules, squeezeseg  # noqa: F401
+from . import data, export, heads, infer, modules, quantize, squeezeseg  # noqa: F401
@@ -1,9 +1,13 @@
 import argparse
 import glob
+import hashlib
 import itertools as it
+import json
 import os
 import os.path as osp
+import shutil
 import sys
+import warnings
 
 import numpy as np
 import torch
@@ -16,6 +20,8 @@ from . import modules, squeezeseg, utils
 
 
 class Dataset(tu.SimpleDataset):
+    COMPILED_FILES = 'files.json'
+
     def __init__(self, config):
         folder = config['folder']
         name = config['name']
@@ -36,15 +42,81 @@ class Dataset(tu.SimpleDataset):
             self.limits = config['limits']
         else:
             self.limits = None
-        super().__init__(folder, name=name, ext=ext, shuffle=shuffle, keep_ram=keep_ram)
+        if 'dropout_noise' in config:  # Applied to loaded samples, so the noise is not cached
+            noise_kwargs = dict(config['dropout_noise'])
+            self.noise_channels = noise_kwargs.pop('channels')
+            self.noise = modules.DropoutNoise(limits=self.limits, **noise_kwargs)
+        else:
+            self.noise_channels = []
+            self.noise = None
+        shared_cache = config.get('shared_cache_mb', 0) * 2 ** 20
+        super().__init__(folder, name=name, ext=ext, shuffle=shuffle, keep_ram=keep_ram and not shared_cache, shared_cache=shared_cache)
+        self.compiled_rows = None
+        self._compiled = None
+        if config.get('compiled', False):
+            try:
+                files = ot.io.read_json(osp.join(self.compiled_dir, self.COMPILED_FILES))
+                self.compiled_rows = {osp.join(self.folder, fname): row for row, fname in enumerate(files)}
+            except OSError:
+                warnings.warn(f'Compiled data {self.compiled_dir} not found, loading raw files! Run compile_dataset.py first.')
+            else:
+                missing = sum(fname not in self.compiled_rows for fname in self.files)
+                if missing:
+                    warnings.warn(f'{missing} files of {self.folder} are not in compiled data, loading them raw! Run compile_dataset.py again.')
+
+    @property
+    def compiled_dir(self):
+        config = json.dumps({'limits': self.limits, 'channels': self.channels}, sort_keys=True)
+        return osp.join(self.folder, 'compiled-' + hashlib.sha1(config.encode('utf-8')).hexdigest()[:12])  # nosec
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = {
+                channel['name']: np.load(osp.join(self.compiled_dir, channel['name'] + '.npy'), mmap_mode='c') for channel in self.channels
+            }
+        return self._compiled
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_compiled'] = None  # Memory maps are reopened in every worker
+        return state
+
+    def __getitem__(self, key):
+        data_item = super().__getitem__(key)
+        if self.noise is None:
+            return data_item
+        mask = self.noise.sample(1)[0].numpy()
+        data_item = dict(data_item)
+        for name in self.noise_channels:
+            channel = data_item[name]
+            data_item[name] = (channel * (mask if channel.ndim == 3 else mask[0])).astype(channel.dtype)
+        return data_item
 
     def load_and_transform(self, fname, key):
-        loaded_data = np.load(fname)
+        row = self.compiled_rows.get(fname) if self.compiled_rows is not None else None
+        if row is not None:
+            result = dict()
+            for name, data in self.compiled.items():
+                result[name] = data[row]
+        else:
+            result = self.transform(np.load(fname))
+        result['key'] = key
+        return result
+
+    def transform(self, loaded_data):
         if self.limits is not None:
             loaded_data = loaded_data[self.limits[0]['min'] : self.limits[0]['max'], self.limits[1]['min'] : self.limits[1]['max'], :]
         result = dict()
-        result['key'] = key
         for channel in self.channels:
+            if 'bilateral' in channel:  # Precomputed CRF weights of channels transformed before
+                kwargs = dict(channel['bilateral'])
+                source = np.concatenate([result[name] for name in ot.utils.listify(kwargs.pop('source'))], 0)
+                result[channel['name']] = modules.bilateral_weights(source, **kwargs).astype(channel.get('retype', 'f2'))
+                continue
+            if 'rgb2gs' in channel:  # Lightness of a rgb channel transformed before, as computed by modules.RGB2GS
+                result[channel['name']] = modules.rgb2gs(result[channel['rgb2gs']]).astype(channel.get('retype', 'f4'))
+                continue
             tmp = loaded_data[..., channel['start'] : channel['end']]
             if len(tmp.shape) != 3:
                 tmp = tmp[..., None]
@@ -58,11 +130,47 @@ class Dataset(tu.SimpleDataset):
             result[channel['name']] = tmp
         return result
 
+    def compile(self):
+        '''Stores transformed channels of all files as contiguous arrays, which are memory mapped when compiled is set in config'''
+        files = sorted(self.files)
+        tmp_dir = self.compiled_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        arrays = dict()
+        for row, fname in enumerate(files):
+            for name, data in self.transform(np.load(fname)).items():
+                if name not in arrays:
+                    arrays[name] = np.lib.format.open_memmap(osp.join(tmp_dir, name + '.npy'), 'w+', data.dtype, (len(files), *data.shape))
+                arrays[name][row] = data
+        for data in arrays.values():
+            data.flush()
+        with open(osp.join(tmp_dir, self.COMPILED_FILES), 'wt', encoding='utf-8') as f:
+            json.dump([osp.relpath(fname, self.folder) for fname in files], f)
+        shutil.rmtree(self.compiled_dir, ignore_errors=True)
+        os.rename(tmp_dir, self.compiled_dir)
+        return self.compiled_dir
+
     def scan_files(self):
         return sorted(glob.glob(osp.join(self.folder, '*' + self.ext)))
 
 
+def runner_args(config):
+    '''Options of tu.Runner given by the config'''
+    return argparse.Namespace(
+        keep_ram=config.get('keep_ram', True),
+        cuda=torch.device(config['device']).type == 'cuda',
+        prefetch=config.get('prefetch', False),
+        amp=config.get('amp', None),
+        channels_last=config.get('channels_last', False),
+        accumulate_steps=config.get('accumulate_steps', 1),
+        micro_batch=config.get('micro_batch', None),
+        profile=config.get('profile', None),
+    )
+
+
 class EvalRunner(tu.Runner):
+    unfused_model = None
+
     def __init__(self, config):
         self.config = config
         device = torch.device(self.config['device'])
@@ -76,7 +184,6 @@ class EvalRunner(tu.Runner):
         loss_fn = utils.create_loss_from_kwargs(**self.config['loss'])
         pass_keys = self.config['pass_keys']
         gt_keys = self.config['gt_keys']
-        keep_ram = self.config.get('keep_ram', True)
         cat_channels = self.config.get('cat_channels', False)
         self.image_fn = utils.create_image_fn(**self.config['image_fn'])
         self.store_dir = None
@@ -90,14 +197,20 @@ class EvalRunner(tu.Runner):
             pass_keys,
             gt_keys,
             verbose=True,
-            args=argparse.Namespace(keep_ram=keep_ram, cuda=True),
+            args=runner_args(self.config),
             use_tqdm=True,
             accum_losses=True,
             cat_channels=cat_channels,
             pass_as_kwargs=True,
             embedder=embed,
             embed_channel=embed_channel,
+            log_interval=self.config.get('log_interval', 10),
+            aux_keys=self.config.get('aux_keys', None),
         )
+        if self.config.get('fuse', False):
+            self.unfused_model = self.model
+        if 'crf_iters' in self.config:
+            modules.set_crf_iterations(self.model, self.config['crf_iters'])
 
     def __call__(self, dataloader, store_dir):
         self.store_dir = store_dir
@@ -107,7 +220,13 @@ class EvalRunner(tu.Runner):
     def load_checkpoint(self, cp):
         if self.embedder is not None and cp['embed'] is not None:
             self.embedder.load_state_dict(cp['embed'])
-        self.model.load_state_dict(cp['state_dict'])
+        if self.unfused_model is not None:
+            self.unfused_model.load_state_dict(cp['state_dict'])
+            self.model = modules.fuse_for_inference(self.unfused_model)
+            if self.profiler is not None:
+                self.profiler.attach(self.model)
+        else:
+            self.model.load_state_dict(cp['state_dict'])
 
     def run_after_iter(self, batch, output, loss, mode, did, batch_id, _, dataset):
         for i in range(len(batch['key'])):
@@ -154,10 +273,13 @@ class Runner(tu.Runner):
         loss_fn = utils.create_loss_from_kwargs(**self.config['loss'])
         pass_keys = self.config['pass_keys']
         gt_keys = self.config['gt_keys']
-        keep_ram = self.config.get('keep_ram', True)
         cat_channels = self.config.get('cat_channels', False)
         self.info_fn = utils.info_fn(**self.config['info_fn'])
         self.info_accum = dict()
+        if self.config.get('checkpoint_format', 'tar') == 'tensors':
+            self.checkpointer = tu.AsyncCheckpointer(self.config.get('checkpoint_keep_last', None), self.config.get('checkpoint_keep_every', None))
+        else:
+            self.checkpointer = None
 
         super().__init__(
             model,
@@ -166,15 +288,21 @@ class Runner(tu.Runner):
             pass_keys,
             gt_keys,
             verbose=True,
-            args=argparse.Namespace(keep_ram=keep_ram, cuda=True),
+            args=runner_args(self.config),
             use_tqdm=True,
             accum_losses=True,
             cat_channels=cat_channels,
             pass_as_kwargs=True,
             embedder=embed,
             embed_channel=embed_channel,
+            log_interval=self.config.get('log_interval', 10),
+            aux_keys=self.config.get('aux_keys', None),
         )
 
+    def close(self):
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+
     def run_pre_epoch(self, dataset, mode):
         self.info_accum[(dataset, mode)] = None
 
@@ -187,20 +315,22 @@ class Runner(tu.Runner):
 
     def run_after_epoch(self, dataset, mode):
         if mode is tu.TorchMode.TRAIN:
+            # Mean of losses summed over batches, loss_sums are already reduced over processes
+            loss_mean = float(self.loss_sums[dataset]) / (self.loss_batches[dataset] * tu.get_world_size())
+        if mode is tu.TorchMode.TRAIN and tu.is_main_process():
             os.makedirs(osp.join(self.config['base_dir'], self.config['store_dir']), exist_ok=True)
-            ot.checkpoint.store_checkpoint(
-                osp.join(self.config['base_dir'], self.config['store_dir'], f'{self.run_times[dataset]:03d}'),
-                {
-                    'state_dict': self.model.state_dict(),
-                    'loss_mean': np.mean([d.cpu().numpy() for d in self.run_losses[dataset]]),
-                    'embed': self.embedder.state_dict() if self.embedder is not None else None,
-                    'optim': self.optimizer.state_dict(),
-                },
-                [sys.modules[__name__.split('.')[0]]],
-                time_format=None,
-                overwrite=True,
-            )
-        acc_info = self.info_accum[(dataset, mode)]
+            cp_name = osp.join(self.config['base_dir'], self.config['store_dir'], f'{self.run_times[dataset]:03d}')
+            cp_data = {
+                'state_dict': tu.unwrap_model(self.model).state_dict(),
+                'loss_mean': loss_mean,
+                'embed': tu.unwrap_model(self.embedder).state_dict() if self.embedder is not None else None,
+                'optim': self.optimizer.state_dict(),
+            }
+            if self.checkpointer is not None:
+                self.checkpointer.save(cp_name + tu.TENSOR_CHECKPOINT_EXT, cp_data, self.run_times[dataset])
+            else:
+                ot.checkpoint.store_checkpoint(cp_name, cp_data, [sys.modules[__name__.split('.')[0]]], time_format=None, overwrite=True)
+        acc_info = tu.all_reduce_sum(self.info_accum[(dataset, mode)])
         classes = (acc_info.shape[0] - 2) // 3
         error = acc_info[0] / acc_info[-1].float()
         extra_string = f'\nMean error for epoch {self.run_times[dataset]:03d} and mode: {mode.name}:\t{error:8.4f}\n'
@@ -215,7 +345,7 @@ class Runner(tu.Runner):
 
     def __call__(self, dataloader, mode):
         super().__call__(dataloader, mode)
-        return sum(self.run_losses[dataloader.dataset]) / len(dataloader.dataset)
+        return self.loss_sums[dataloader.dataset] / len(dataloader.dataset)
 
 
 class RGB2GSRunner(EvalRunner):
@@ -227,7 +357,6 @@ class RGB2GSRunner(EvalRunner):
         loss_fn = utils.create_loss_from_kwargs(**self.config['loss'])
         pass_keys = ['rgb']
         gt_keys = ['intensity', 'mask', 'rgb_mask']
-        keep_ram = self.config.get('keep_ram', True)
         cat_channels = self.config.get('cat_channels', False)
         self.image_fn = utils.create_image_fn(**self.config['image_fn'])
         self.info_fn = utils.info_fn(**self.config['info_fn'])
@@ -241,11 +370,13 @@ class RGB2GSRunner(EvalRunner):
             pass_keys,
             gt_keys,
             verbose=True,
-            args=argparse.Namespace(keep_ram=keep_ram, cuda=True),
+            args=runner_args(self.config),
             use_tqdm=True,
             accum_losses=True,
             cat_channels=cat_channels,
             pass_as_kwargs=True,
             embedder=None,
             embed_channel=None,
+            log_interval=self.config.get('log_interval', 10),
+            aux_keys=self.config.get('aux_keys', None),
         )
@@ -0,0 +1,74 @@
+import os.path as osp
+import warnings
+
+import numpy as np
+import torch
+
+from . import modules
+
+try:
+    import onnxruntime
+
+    _ORT_FOUND = True
+except ImportError:
+    _ORT_FOUND = False
+
+EXPORT_FORMATS = {'.pt': 'torchscript', '.onnx': 'onnx'}
+
+
+def export_format(path):
+    ext = osp.splitext(path)[1]
+    if ext not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {ext}, use one of {list(EXPORT_FORMATS)}!')
+    return EXPORT_FORMATS[ext]
+
+
+def export_model(model, path, channels, height, width, fuse=True):
+    '''
+    Exports model for inputs of shape (batch, channels, height, width) to TorchScript (.pt) or ONNX (.onnx) by tracing.
+    The padding of the bone and the cropping of the heads are resolved for the given width, so the artefact only accepts
+    grids of this width, the batch size stays free. With fuse, batch normalizations are folded into convolutions first.
+    '''
+    model = modules.fuse_for_inference(model) if fuse else model.eval()
+    param = next(model.parameters())
+    example = torch.zeros(1, channels, height, width, dtype=param.dtype, device=param.device)
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)  # Shapes are meant to become constants
+        if export_format(path) == 'onnx':
+            output_names = [f'output{i}' for i in range(len(model(example)))]
+            torch.onnx.export(
+                model,
+                (example,),
+                path,
+                input_names=['grid'],
+                output_names=output_names,
+                dynamic_axes={name: {0: 'batch'} for name in ['grid', *output_names]},
+                dynamo=False,
+            )
+        else:
+            traced = torch.jit.freeze(torch.jit.trace(model, example, check_trace=False))
+            torch.jit.save(traced, path)
+
+
+class OnnxModule:
+    '''Runs an exported ONNX model by onnxruntime on cpu, taking and returning tensors as the eager model'''
+
+    def __init__(self, path, threads=None):
+        if not _ORT_FOUND:
+            raise RuntimeError('Running ONNX models needs onnxruntime, install it first!')
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, data):
+        outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(data.detach().cpu().numpy())})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+def load_exported(path, device='cpu'):
+    '''Loads model stored by export_model, ONNX models run on cpu'''
+    if export_format(path) == 'onnx':
+        return OnnxModule(path)
+    return torch.jit.load(path, map_location=device)
@@ -51,9 +51,7 @@ class L2ReflectHead(nn.Module):
 
     def forward(self, data_input, features):
         out = self.net(features)
-        if out.shape[-1] != data_input.shape[-1]:
-            diff = out.shape[-1] - data_input.shape[-1]
-            out = out[..., (diff // 2) : -(diff // 2)]
+        out = md.crop_width(out, data_input)
         return (out,)
 
 
@@ -77,9 +75,7 @@ class ReflectHead(nn.Module):
 
     def forward(self, data_input, features):
         up = self.up(features)
-        if up.shape[-1] != data_input.shape[-1]:
-            diff = up.shape[-1] - data_input.shape[-1]
-            up = up[..., (diff // 2) : -(diff // 2)]
+        up = md.crop_width(up, data_input)
         clazz = self.clazz(up)
         sq = self.sq(clazz)
         sm = self.sm(up)
@@ -101,10 +97,8 @@ class SegmentHead(nn.Module):
         )
         self.crf = md.CRF(crf_iters, crf_start_dim, crf_dims, **crf_kwargs)
 
-    def forward(self, data_input, features):
+    def forward(self, data_input, features, bilateral=None):
         result = self.net(features)
-        if result.shape[-1] != data_input.shape[-1]:
-            diff = result.shape[-1] - data_input.shape[-1]
-            result = result[..., (diff // 2) : -(diff // 2)]
-        result = self.crf(data_input, result)
+        result = md.crop_width(result, data_input)
+        result = self.crf(data_input, result, bilateral)
         return result
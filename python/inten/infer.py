@@ -0,0 +1,175 @@
+import collections
+import concurrent.futures as cf
+import glob
+import os
+import os.path as osp
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+
+import torchutils as tu
+
+from . import modules, squeezeseg
+
+# Grid channels: Depth, X, Y, Z, Label, Red, Green, Blue, Color_mask, Returned_ray_mask, ...
+GRID_INPUT_CHANNELS = (0, 5, 6, 7, 8, 9)
+GRID_DEPTH_SCALE = 131.0
+INTENSITY_COLUMN = 4
+
+
+class GridFolder(data.Dataset):
+    '''Lidar sweep grids of a folder, yields model inputs with depth scaled as in the training data'''
+
+    def __init__(self, files, channels=GRID_INPUT_CHANNELS, depth_scale=GRID_DEPTH_SCALE):
+        self.files = files
+        self.channels = list(channels)
+        self.depth_scale = depth_scale
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, key):
+        grid = np.load(self.files[key], mmap_mode='r')
+        inputs = np.ascontiguousarray(np.moveaxis(grid[..., self.channels], -1, 0), dtype=np.float32)
+        inputs[0] /= self.depth_scale
+        return {'key': key, 'data': torch.from_numpy(inputs)}
+
+
+class TiledModel(nn.Module):
+    '''
+    Runs model on windows of tile_width columns, overlapping by overlap columns, and blends their outputs by linear ramps over
+    the overlaps. Memory of activations depends on tile_width and tiles_per_batch, not on the width of grids. With cyclic, windows
+    wrap around the grid, as full 360 degree scans have no left and right border, otherwise border columns are repeated.
+    tile_width should be divisible by the reduction of the bone (32 by default), so windows are not padded by the model.
+    '''
+
+    def __init__(self, model, tile_width=512, overlap=64, tiles_per_batch=8, cyclic=True):
+        super().__init__()
+        if not 0 <= overlap < tile_width:
+            raise ValueError(f'Overlap {overlap} must be smaller than tiles of {tile_width} columns!')
+        self.model = model
+        self.tile_width = tile_width
+        self.overlap = overlap
+        self.tiles_per_batch = tiles_per_batch
+        self.cyclic = cyclic
+        ramp = torch.arange(tile_width, dtype=torch.float)
+        ramp = torch.minimum(ramp + 1, tile_width - ramp) / (overlap + 1)
+        self.register_buffer('blend', ramp.clamp(max=1), persistent=False)
+
+    def columns(self, width, device=None):
+        '''Grid columns of all windows, (tiles, tile_width)'''
+        step = self.tile_width - self.overlap
+        tiles = -(-width // step)
+        columns = torch.arange(tiles, device=device)[:, None] * step - self.overlap // 2 + torch.arange(self.tile_width, device=device)
+        return columns % width if self.cyclic else columns.clamp(0, width - 1)
+
+    def forward(self, x):
+        batch, _, height, width = x.shape
+        columns = self.columns(width, x.device)
+        tiles = columns.shape[0]
+        index = columns.flatten()
+        # (batch * tiles, channels, height, tile_width), batches of windows may span more grids
+        windows = x.index_select(-1, index).unflatten(-1, columns.shape).permute(0, 3, 1, 2, 4).flatten(0, 1)
+        outputs = [self.model(chunk) for chunk in windows.split(self.tiles_per_batch)]
+        single = isinstance(outputs[0], torch.Tensor)
+        if single:
+            outputs = [(output,) for output in outputs]
+        blend = self.blend.to(x.device)
+        norm = blend.new_zeros(width).index_add_(0, index, blend.repeat(tiles))
+        results = []
+        for parts in zip(*outputs):
+            pred = torch.cat(parts) * blend.to(parts[0].dtype)
+            pred = pred.unflatten(0, (batch, tiles)).permute(0, 2, 3, 1, 4).flatten(3)
+            results.append(pred.new_zeros(*pred.shape[:3], width).index_add_(-1, index, pred) / norm.to(pred.dtype))
+        return results[0] if single else tuple(results)
+
+
+def load_model(config, weights, device, fuse=False):
+    '''SqueezeWithHead of config with weights from a state dict file or a checkpoint, prepared for inference'''
+    model = squeezeseg.SqueezeWithHead.load_from_kwargs(config['model'])
+    if weights.endswith('.pt'):
+        state_dict = torch.load(weights, map_location='cpu')
+    else:
+        state_dict = tu.load_checkpoint_file(weights)['state_dict']
+    model.load_state_dict(state_dict)
+    model = model.to(device).eval()
+    if fuse:
+        model = modules.fuse_for_inference(model)
+    if 'crf_iters' in config:
+        modules.set_crf_iterations(model, config['crf_iters'])
+    return model
+
+
+def _store(grid_file, destination, intensity, column):
+    '''Writes the grid as a point cloud with the predicted intensity inserted at column, atomically, so resuming skips only complete files'''
+    grid = np.load(grid_file)
+    pcl = grid.reshape(-1, grid.shape[-1])
+    result = np.empty((pcl.shape[0], pcl.shape[1] + 1), dtype=pcl.dtype)
+    result[:, :column] = pcl[:, :column]
+    result[:, column] = intensity.reshape(-1)
+    result[:, column + 1 :] = pcl[:, column:]
+    tmpname = destination + '.tmp'
+    with open(tmpname, 'wb') as f:
+        np.save(f, result)
+    os.replace(tmpname, destination)
+
+
+def infer_folder(
+    model,
+    grid_folder,
+    output_folder,
+    batch_size=8,
+    num_workers=2,
+    writers=2,
+    device='cpu',
+    amp=None,
+    channels_last=False,
+    overwrite=False,
+    log_interval=10,
+    dataset_kwargs=None,
+):
+    '''
+    Predicts intensities of all grids in grid_folder and stores them as point clouds of the same name in output_folder.
+    The model is an eager model or one loaded by export.load_exported.
+    Grids are read by a prefetching loader and outputs are written by a pool of writer threads. Unless overwrite is set,
+    grids with a stored output are skipped, so an interrupted run continues where it stopped. Returns number of processed grids.
+    '''
+    device = torch.device(device)
+    os.makedirs(output_folder, exist_ok=True)
+    files = sorted(glob.glob(osp.join(grid_folder, '*.npy')))
+    destinations = [osp.join(output_folder, osp.basename(fname)) for fname in files]
+    todo = [i for i, destination in enumerate(destinations) if overwrite or not osp.exists(destination)]
+    print(f'{len(files) - len(todo)} of {len(files)} grids already processed')
+    if not todo:
+        return 0
+    dataset = GridFolder([files[i] for i in todo], **(dataset_kwargs or {}))
+    loader = data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=device.type == 'cuda')
+    dtype = tu.amp_dtype(amp, device.type)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    if channels_last:
+        model = model.to(memory_format=memory_format)
+    done = 0
+    start = time.perf_counter()
+    pending: collections.deque = collections.deque()
+    with cf.ThreadPoolExecutor(writers) as pool, torch.inference_mode():
+        for batch_id, batch in enumerate(tu.BatchPrefetcher(loader, device)):
+            inputs = batch['data'].to(device, non_blocking=True).contiguous(memory_format=memory_format)
+            with torch.autocast(device.type, dtype, enabled=dtype is not None):
+                *_, pred = model(inputs)
+            pred = pred.float().cpu().numpy()
+            for key, intensity in zip(batch['key'].tolist(), pred):
+                i = todo[key]
+                pending.append(pool.submit(_store, files[i], destinations[i], intensity, INTENSITY_COLUMN))
+            while len(pending) > 2 * max(writers, 1) * batch_size:  # Bounds outputs waiting in memory
+                pending.popleft().result()
+            done += len(pred)
+            if (batch_id + 1) % log_interval == 0:
+                print(f'{done}/{len(todo)} grids, {done / (time.perf_counter() - start):.2f} frames/s')
+        for future in pending:
+            future.result()
+    elapsed = time.perf_counter() - start
+    print(f'Processed {done} grids in {elapsed:.1f} s, {done / elapsed:.2f} frames/s')
+    return done
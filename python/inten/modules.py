@@ -1,9 +1,36 @@
+import contextlib
+import copy
 import os.path as osp
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
+
+import torchutils as tu
+
+
+def pad_width(x, multiple):
+    '''Replicates border columns, so the width of x is divisible by multiple'''
+    over = x.shape[-1] % multiple
+    if over:
+        over = multiple - over
+        x = F.pad(x, (over // 2, over // 2, 0, 0), 'replicate')
+    return x
+
+
+def crop_width(x, reference):
+    '''Crops padded columns of x back to the width of reference'''
+    if x.shape[-1] != reference.shape[-1]:
+        diff = x.shape[-1] - reference.shape[-1]
+        x = x[..., (diff // 2) : -(diff // 2)]
+    return x
+
+
+# Width dependent shapes stay opaque calls in symbolic traces, e.g. for quantization
+torch.fx.wrap('pad_width')
+torch.fx.wrap('crop_width')
 
 
 class Fire(nn.Module):
@@ -118,12 +145,126 @@ class DeConv(nn.Module):
         return self.net(x)
 
 
+class ShiftedReLU(nn.Module):
+    '''ReLU followed by a per channel shift, which the preceding convolution already added to its output'''
+
+    def __init__(self, shift):
+        super().__init__()
+        self.register_buffer('shift', shift[None, :, None, None])
+
+    def forward(self, x):
+        return x.clamp_(min=self.shift)
+
+
+class ReLUAffine(nn.Module):
+    '''ReLU followed by a per channel affine transform as a single multiply-add'''
+
+    def __init__(self, scale, shift, inplace=False):
+        super().__init__()
+        self.inplace = inplace
+        self.register_buffer('scale', scale[None, :, None, None])
+        self.register_buffer('shift', shift[None, :, None, None])
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, torch.relu_(x) if self.inplace else torch.relu(x), self.scale)
+
+
+def _fuse_sequential(seq):
+    layers = list(seq)
+    fused = []
+    i = 0
+    while i < len(layers):
+        if i + 1 < len(layers) and isinstance(layers[i], nn.ReLU) and isinstance(layers[i + 1], nn.BatchNorm2d):
+            norm = layers[i + 1]
+            scale = (norm.weight if norm.affine else 1) / torch.sqrt(norm.running_var + norm.eps)
+            shift = (norm.bias if norm.affine else 0) - norm.running_mean * scale
+            conv = fused[-1] if fused else None
+            if isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and conv.groups == 1 and bool((scale > 0).all()):
+                # a * relu(z) + b = max(a * z + b, b) for a > 0
+                shape = [1] * conv.weight.dim()
+                shape[1 if isinstance(conv, nn.ConvTranspose2d) else 0] = -1
+                conv.weight.mul_(scale.view(shape))
+                bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+                conv.bias = nn.Parameter(bias * scale + shift)
+                fused.append(ShiftedReLU(shift))
+            else:
+                fused.append(ReLUAffine(scale, shift, layers[i].inplace))
+            i += 2
+        else:
+            fused.append(layers[i])
+            i += 1
+    if len(fused) != len(layers):
+        for key in list(seq._modules):
+            del seq._modules[key]
+        for i, layer in enumerate(fused):
+            seq.add_module(str(i), layer)
+
+
+def fuse_for_inference(model):
+    '''
+    Copy of model for inference, with BatchNorm layers following ReLU merged into the preceding convolutions.
+    BatchNorm with positive scales is folded into the convolution, leaving a single in place max, otherwise ReLU and
+    BatchNorm are replaced by a fused affine transform. The model must not be trained afterwards.
+    '''
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, nn.Sequential):
+                _fuse_sequential(module)
+    return model
+
+
+@contextlib.contextmanager
+def _frozen_norm_stats(module):
+    '''Recomputed forward pass must not update running statistics of BatchNorm layers for the second time'''
+    norms = [norm for norm in module.modules() if isinstance(norm, nn.modules.batchnorm._BatchNorm) and norm.track_running_stats]
+    stash = [(norm.momentum, norm.num_batches_tracked.clone()) for norm in norms]
+    for norm in norms:
+        norm.momentum = 0.0
+    try:
+        yield
+    finally:
+        for norm, (momentum, tracked) in zip(norms, stash):
+            norm.momentum = momentum
+            norm.num_batches_tracked.copy_(tracked)
+
+
+@contextlib.contextmanager
+def _recomputation(module):
+    '''Recomputed forward pass is neither profiled nor updates statistics of BatchNorm layers again'''
+    with tu.no_profiling(), _frozen_norm_stats(module):
+        yield
+
+
+def recompute(module, x, enabled=True):
+    '''Runs module without storing its activations for backward, they are recomputed during backward instead'''
+    if not (enabled and module.training and torch.is_grad_enabled()):
+        return module(x)
+    return cp.checkpoint(module, x, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), _recomputation(module)))
+
+
+def parse_levels(levels):
+    '''Normalizes levels for activation recomputation, True stands for all of them'''
+    if levels is True:
+        return True
+    return frozenset(levels or ())
+
+
+def sublevels(levels):
+    if levels is True:
+        return True
+    return frozenset(level - 1 for level in levels if level > 0)
+
+
 class SqueezePart(nn.Module):
     SQ_ADD = 16
     EF_ADD = 64
 
-    def __init__(self, input_channels, sq, ef, depth, cam_depth=0, top_parent=None):
+    def __init__(self, input_channels, sq, ef, depth, cam_depth=0, top_parent=None, checkpoint_levels=()):
+        '''checkpoint_levels lists recursion levels (0 for this one) whose Fire activations are recomputed in backward'''
         super().__init__()
+        levels = parse_levels(checkpoint_levels)
+        self.checkpoint = levels is True or 0 in levels
         cam = cam_depth > 0
         if depth == 0:
             self.net = nn.Sequential(
@@ -136,18 +277,21 @@ class SqueezePart(nn.Module):
             self.beg = nn.Sequential(Fire(input_channels, sq, ef, cam, top_parent=top_parent), Fire(2 * ef, sq, ef, cam, top_parent=top_parent))
             self.rest = nn.Sequential(
                 Pool(3, 2, 1, top_parent=top_parent),
-                SqueezePart(2 * ef, sq + self.SQ_ADD, ef + self.EF_ADD, depth - 1, cam_depth - 1, top_parent=top_parent),
+                SqueezePart(
+                    2 * ef, sq + self.SQ_ADD, ef + self.EF_ADD, depth - 1, cam_depth - 1, top_parent=top_parent, checkpoint_levels=sublevels(levels)
+                ),
                 DeFire(2 * (ef + self.EF_ADD * (2 if depth == 1 else 1)), 2 * sq, ef, top_parent=top_parent),
             )
         self.depth = depth
 
     def forward(self, x):
         if self.depth:
-            pre_add = self.beg(x)
-            insides = self.rest(pre_add)
+            pre_add = recompute(self.beg, x, self.checkpoint)
+            pool, inner, defire = self.rest
+            insides = recompute(defire, inner(pool(pre_add)), self.checkpoint)
             return pre_add + insides
         else:
-            return self.net(x)
+            return recompute(self.net, x, self.checkpoint)
 
 
 class XYZ(nn.Module):
@@ -161,25 +305,19 @@ class XYZ(nn.Module):
         super().__init__()
         self.dist_dim = dist_dim
         self.mask_dim = mask_dim
-        self.ray = torch.from_numpy(self.ray)
         self.x_start = x_start
-        self.vert_rotmat = torch.from_numpy(
-            np.array([[[np.cos(angle), 0, -np.sin(angle)], [0, 1, 0], [np.sin(angle), 0, np.cos(angle)]] for angle in self.vert_angles])
-        )
-        self.hor_rotmat = torch.from_numpy(
-            np.array([[[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]] for angle in self.hor_angles])
-        )
+        vert_rotmat = np.array([[[np.cos(angle), 0, -np.sin(angle)], [0, 1, 0], [np.sin(angle), 0, np.cos(angle)]] for angle in self.vert_angles])
+        hor_rotmat = np.array([[[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]] for angle in self.hor_angles])
+        # Unit ray of every pixel, (3, rows, columns), computed in double precision as hor_rotmat[x] @ vert_rotmat[y] @ ray
+        rays = np.einsum('xij,yjk,k->iyx', hor_rotmat, vert_rotmat, self.ray)
+        self.register_buffer('rays', torch.from_numpy(rays).float(), persistent=False)
 
     def forward(self, data):
-        batch, y, x = torch.nonzero(data[:, self.mask_dim, ...] >= 0.5, as_tuple=True)
-        matx = self.x_start + x
-        pts = (self.hor_rotmat[matx, ...] @ self.vert_rotmat[y, ...] @ self.ray).float()
-        dists = data[batch, self.dist_dim, y, x, None]
-        b, _, ys, xs = data.shape
-        result = torch.zeros(b, 4, ys, xs, dtype=data.dtype, device=data.device)
-        result[batch, :3, y, x] = dists * pts
-        result[:, 3, ...] = data[:, self.mask_dim, ...]
-        return result
+        _, _, ys, xs = data.shape
+        rays = self.rays[:, :ys, self.x_start : self.x_start + xs]
+        mask = data[:, self.mask_dim, None, ...]
+        xyz = torch.where(mask >= 0.5, data[:, self.dist_dim, None, ...] * rays, 0).to(data.dtype)
+        return torch.cat((xyz, mask), 1)
 
 
 class CRF(nn.Module):
@@ -218,8 +356,12 @@ class CRF(nn.Module):
         self.ang_compat.weight = nn.Parameter(torch.from_numpy(init * ang_coef))
         self.bi_ang_compat.weight = nn.Parameter(torch.from_numpy(init * bi_coef))
 
-    def forward(self, lidar_input, data):
-        bf_weights = self.bilateral(lidar_input[:, self.bf_start_dim : self.bf_start_dim + self.bf_dims])
+    def forward(self, lidar_input, data, bilateral=None):
+        '''bilateral are optional weights precomputed by bilateral_weights, e.g. stored in a dataset channel'''
+        if bilateral is None:
+            bf_weights = self.bilateral(lidar_input[:, self.bf_start_dim : self.bf_start_dim + self.bf_dims])
+        else:
+            bf_weights = bilateral.to(data.dtype)
         mask = (lidar_input[:, self.mask_dim, None, ...] >= 0.5).float()
         for _ in range(self.iterations):
             unary = F.softmax(data, 1)
@@ -231,21 +373,64 @@ class CRF(nn.Module):
         return outputs
 
 
+def bilateral_weights(data, size_a=3, size_b=5, sq_var=None):
+    '''Bilateral weights of CRF for a single sample of shape (channels, height, width) as a numpy array'''
+    if sq_var is None:
+        sq_var = CRF.SQ_VAR_BI
+    weights = _BilateralWeights(size_a, size_b, data.shape[0], np.asarray(sq_var))
+    with torch.no_grad():
+        return weights(torch.from_numpy(np.ascontiguousarray(data))[None])[0].numpy()
+
+
+def set_crf_iterations(model, iterations):
+    '''Changes number of mean field iterations of all CRF layers of model, e.g. to trade accuracy for speed in inference'''
+    for module in model.modules():
+        if isinstance(module, CRF):
+            module.iterations = iterations
+
+
 class DropoutNoise(nn.Module):
-    def __init__(self, np_file=osp.join(osp.dirname(osp.abspath(__file__)), 'mask.npy')):
+    '''
+    Multiplies samples by Bernoulli masks, whose per pixel probabilities are loaded from np_file and cropped by limits given
+    in the format of dataset config. With seed, masks are drawn from an own generator, offset by the seed of DataLoader worker,
+    which differs among workers and among epochs of non-persistent workers, so masks are reproducible given the torch seed.
+    '''
+
+    def __init__(self, np_file=osp.join(osp.dirname(osp.abspath(__file__)), 'mask.npy'), limits=None, seed=None):
         super().__init__()
-        self.mask = torch.from_numpy(np.load(np_file)).clamp(0, 1)[None, ...]
+        mask = np.load(np_file)
+        if limits is not None:
+            mask = mask[limits[0]['min'] : limits[0]['max'], limits[1]['min'] : limits[1]['max']]
+        self.register_buffer('mask', torch.from_numpy(mask).float().clamp(0, 1)[None, None, ...], persistent=False)
+        self.seed = seed
+        self._generator = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_generator'] = None  # Every process seeds its own
+        return state
+
+    def generator(self):
+        if self.seed is None:
+            return None
+        if self._generator is None or self._generator.device != self.mask.device:
+            worker = torch.utils.data.get_worker_info()
+            self._generator = torch.Generator(self.mask.device)
+            self._generator.manual_seed((self.seed + (worker.seed if worker is not None else 0)) % 2 ** 64)
+        return self._generator
+
+    def sample(self, batch_size):
+        '''Masks of shape (batch_size, 1, height, width)'''
+        return torch.bernoulli(self.mask.expand(batch_size, -1, -1, -1), generator=self.generator())
 
     def forward(self, data):
-        bsize = data.shape[0]
-        for i in range(bsize):
-            mask = torch.bernoulli(self.mask).float()
-            data[i] *= mask
-        return data
+        if data.dim() == 3:
+            return data * self.sample(1)[0]
+        return data * self.sample(data.shape[0])
 
 
 class RGB2GS(nn.Module):
-    _RGB2GS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32).reshape((1, 3, 1, 1))
+    _RGB2GS = (0.2126, 0.7152, 0.0722)
     _GAMMA = 2.2
     _MULT = 116
     _EXP = 1 / 3
@@ -258,22 +443,35 @@ class RGB2GS(nn.Module):
     def __init__(self, dim_start=0, as_tuple=False):
         super().__init__()
         self.dim_start = dim_start
-        self.conv = nn.Conv2d(3, 1, 1, bias=False)
-        self.conv.weight = nn.Parameter(torch.from_numpy(self._RGB2GS), requires_grad=False)
+        self.register_buffer('weights', torch.tensor(self._RGB2GS).view(1, 3, 1, 1), persistent=False)
         self.as_tuple = as_tuple
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        state_dict.pop(prefix + 'conv.weight', None)  # Fixed weights of the former 1x1 convolution
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @classmethod
+    def lightness(cls, rgb, weights):
+        '''Lightness of rgb channels along dimension 1, branch free, so it is traceable and needs no synchronization'''
+        gs = (rgb.pow(cls._GAMMA) * weights.to(rgb.dtype)).sum(1, keepdim=True)
+        # Clamped, so the unused branch has no infinite gradient at zero
+        gs = torch.where(gs > cls._THRESH_CU, gs.clamp(min=cls._THRESH_CU).pow(cls._EXP), gs / cls._THRESH_SQ_THR + cls._ADD)
+        return (cls._MULT * gs - cls._MINUS) / cls._NORM
+
     def forward(self, data):
-        rgb = data[:, self.dim_start : self.dim_start + 3]
-        rgb = rgb ** self._GAMMA
-        gs = self.conv(rgb)
-        mask = gs > self._THRESH_CU
-        gs[mask] = gs[mask] ** self._EXP
-        gs[~mask] = gs[~mask] / self._THRESH_SQ_THR + self._ADD
-        gs = (self._MULT * gs - self._MINUS) / self._NORM
-        data = torch.cat((data[:, : self.dim_start], gs, data[:, self.dim_start + 3 :]), 1)
+        gs = self.lightness(data[:, self.dim_start : self.dim_start + 3], self.weights)
+        gs = torch.cat((data[:, : self.dim_start], gs, data[:, self.dim_start + 3 :]), 1)
         if self.as_tuple:
-            return (data,)
-        return data
+            return (gs,)
+        return gs
+
+
+def rgb2gs(rgb, dim=0):
+    '''Lightness of rgb channels along dim of a numpy array as computed by RGB2GS, an offline counterpart of ot.visual.rgb2gs'''
+    data = torch.from_numpy(np.ascontiguousarray(np.moveaxis(rgb, dim, 0)))
+    with torch.no_grad():
+        gs = RGB2GS.lightness(data.float()[None], torch.tensor(RGB2GS._RGB2GS).view(1, 3, *([1] * (data.dim() - 1))))[0]
+    return np.moveaxis(gs.numpy(), 0, dim)
 
 
 class _LocalPassing(nn.Module):
@@ -282,36 +480,64 @@ class _LocalPassing(nn.Module):
             sq_var_bi = sq_var_ang
         pad = (size_a // 2, size_b // 2)
         super().__init__()
+        self.pad = pad
+        self.offsets = _neighbour_offsets(size_a, size_b)
+        # Keeps the mapping of the original dense condensing convolution. Its channel n * in_channels + k held the n-th neighbour
+        # of class k and it was viewed as (class, neighbour) pairs, so the neighbour goes to message of class (n * in_channels + k) // N
+        neighbours = len(self.offsets)
+        self.targets = [[(n * in_channels + k) // neighbours for k in range(in_channels)] for n in range(neighbours)]
         self.ang_conv = nn.Conv2d(in_channels, in_channels, (size_a, size_b), padding=pad, bias=False)
         self.bi_ang_conv = nn.Conv2d(in_channels, in_channels, (size_a, size_b), padding=pad, bias=False)
-        self.condense_conv = nn.Conv2d(in_channels, (size_a * size_b - 1) * in_channels, (size_a, size_b), padding=pad, bias=False)
 
         self.ang_conv.weight = nn.Parameter(torch.from_numpy(_gauss_weights(size_a, size_b, in_channels, sq_var_ang)), requires_grad=False)
         self.bi_ang_conv.weight = nn.Parameter(torch.from_numpy(_gauss_weights(size_a, size_b, in_channels, sq_var_bi)), requires_grad=False)
-        self.condense_conv.weight = nn.Parameter(torch.from_numpy(_condensing_weights(size_a, size_b, in_channels)), requires_grad=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        state_dict.pop(prefix + 'condense_conv.weight', None)  # Fixed weights of older models
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, data, mask, bilateral):
-        b, c, h, w = data.shape
+        h, w = data.shape[-2:]
         ang = self.ang_conv(data)
         bi_ang = self.bi_ang_conv(data)
-        condense = self.condense_conv(data * mask).view(b, c, -1, h, w)
-        bi_out = (condense * bilateral).sum(2) * mask * bi_ang
+        padded = F.pad(data * mask, (self.pad[1], self.pad[1], self.pad[0], self.pad[0]))
+        weights = bilateral.flatten(1, 2)
+        channels = data.shape[1]
+        messages = [0] * channels
+        for n, (i, j) in enumerate(self.offsets):
+            weighted = padded[:, :, i : i + h, j : j + w] * weights[:, n * channels : (n + 1) * channels]
+            for target, message in zip(self.targets[n], weighted.unbind(1)):
+                messages[target] = messages[target] + message
+        bi_out = torch.stack(messages, 1) * mask * bi_ang
         return ang, bi_out
 
 
 class _BilateralWeights(nn.Module):
     def __init__(self, size_a, size_b, in_channels, sq_var):
         super().__init__()
-        pad = (size_a // 2, size_b // 2)
+        self.pad = (size_a // 2, size_b // 2)
+        self.offsets = _neighbour_offsets(size_a, size_b)
         self.in_channels = in_channels
         self.sq_var = sq_var
-        self.condense_conv = nn.Conv2d(in_channels, (size_a * size_b - 1) * in_channels, (size_a, size_b), padding=pad, bias=False)
-        self.condense_conv.weight = nn.Parameter(torch.from_numpy(_condensing_weights(size_a, size_b, in_channels)), requires_grad=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        state_dict.pop(prefix + 'condense_conv.weight', None)  # Fixed weights of older models
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, data):
-        condensed = self.condense_conv(data)
-        diffs = [data[:, i, None, ...] - condensed[:, i :: self.in_channels, ...] for i in range(self.in_channels)]
-        return torch.stack([torch.exp_(-sum([diff ** 2 for diff in diffs]) / (2 * self.sq_var[i])) for i in range(len(self.sq_var))], 1)
+        b, _, h, w = data.shape
+        padded = F.pad(data, (self.pad[1], self.pad[1], self.pad[0], self.pad[0]))
+        result = data.new_empty((b, len(self.sq_var), len(self.offsets), h, w))
+        for n, (i, j) in enumerate(self.offsets):
+            sq_dist = sum([(data[:, k] - padded[:, k, i : i + h, j : j + w]) ** 2 for k in range(self.in_channels)])
+            for c, sq_var in enumerate(self.sq_var):
+                result[:, c, n] = torch.exp_(-sq_dist / (2 * sq_var))
+        return result
+
+
+def _neighbour_offsets(size_a, size_b):
+    '''Positions of neighbours in the padded window, in the order of the original condensing convolution'''
+    return [(i, j) for i in range(size_a) for j in range(size_b) if (i, j) != (size_a // 2, size_b // 2)]
 
 
 def _gauss_weights(size_a, size_b, num_classes, sq_var):
@@ -325,14 +551,3 @@ def _gauss_weights(size_a, size_b, num_classes, sq_var):
         kernel_2d[size_a // 2, size_b // 2] = 0
         kernel[k, k] = kernel_2d
     return kernel
-
-
-def _condensing_weights(size_a, size_b, in_channels):
-    half_filter_dim = (size_a * size_b) // 2
-    kernel = np.zeros((size_a * size_b * in_channels, in_channels, size_a, size_b), dtype=np.float32)
-    for i in range(size_a):
-        for j in range(size_b):
-            for k in range(in_channels):
-                kernel[i * (size_b * in_channels) + j * in_channels + k, k, i, j] = 1
-    kernel = np.concatenate([kernel[: in_channels * half_filter_dim], kernel[in_channels * (half_filter_dim + 1) :]], axis=0)
-    return kernel
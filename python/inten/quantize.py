@@ -0,0 +1,34 @@
+import copy
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_fx
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+
+from . import modules
+
+QUANTIZATION_BACKENDS = ('x86', 'fbgemm', 'qnnpack', 'onednn')
+
+
+def quantize_static(model, batches, backend='x86'):
+    '''
+    Copy of SqueezeWithHead with int8 weights and activations for cpu inference, calibrated on input batches.
+    The bone and the head are quantized as separate graphs, CRF layers stay in float.
+    '''
+    if backend not in QUANTIZATION_BACKENDS:
+        raise ValueError(f'Unknown quantization backend {backend}, use one of {list(QUANTIZATION_BACKENDS)}!')
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(modules.CRF, None)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes([modules.CRF])
+    model = copy.deepcopy(model).cpu().eval()
+    batches = iter(batches)
+    with torch.no_grad():
+        example = next(batches)
+        features = model.squeeze(example)
+        model.squeeze = quantize_fx.prepare_fx(model.squeeze, qconfig_mapping, (example,), custom_config)
+        model.head = quantize_fx.prepare_fx(model.head, qconfig_mapping, (example, features), custom_config)
+        model(example)
+        for batch in batches:  # Observers collect ranges of activations
+            model(batch)
+    model.squeeze = quantize_fx.convert_fx(model.squeeze)
+    model.head = quantize_fx.convert_fx(model.head)
+    return model
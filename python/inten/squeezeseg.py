@@ -1,5 +1,4 @@
 import torch.nn as nn
-import torch.nn.functional as F
 import yaml
 
 from . import heads
@@ -12,9 +11,9 @@ class SqueezeWithHead(nn.Module):
         self.squeeze = SqueezeSegBone(**squeeze_kwargs)
         self.head = head_cls(**head_kwargs)
 
-    def forward(self, x):
+    def forward(self, x, **head_kwargs):
         features = self.squeeze(x)
-        return self.head(x, features)
+        return self.head(x, features, **head_kwargs)
 
     @classmethod
     def load_from_kwargs(cls, data):
@@ -33,9 +32,15 @@ class SqueezeWithHead(nn.Module):
 
 
 class SqueezeSegBone(nn.Module):
-    def __init__(self, input_channels, squeeze_depth=2, cam_depth=1, conv_starts=64, squeeze_start=16, ef_start=64):
+    def __init__(self, input_channels, squeeze_depth=2, cam_depth=1, conv_starts=64, squeeze_start=16, ef_start=64, checkpoint_levels=()):
+        '''
+        checkpoint_levels lists levels whose activations are recomputed in backward instead of being stored, True for all of them.
+        Level 0 are the full resolution blocks, level 1 the outermost SqueezePart and so on.
+        '''
         super().__init__()
         self.reduce = 1
+        levels = md.parse_levels(checkpoint_levels)
+        self.checkpoint = levels is True or 0 in levels
         self.start = nn.Sequential(
             md.Conv(input_channels, conv_starts, 3, 1, 2, top_parent=self),
             md.ContextAggregation(conv_starts, top_parent=self),
@@ -43,18 +48,15 @@ class SqueezeSegBone(nn.Module):
         )
         self.rest = nn.Sequential(
             md.Pool(3, 2, 1, top_parent=self),
-            md.SqueezePart(conv_starts, squeeze_start, ef_start, squeeze_depth, cam_depth, top_parent=self),
+            md.SqueezePart(conv_starts, squeeze_start, ef_start, squeeze_depth, cam_depth, top_parent=self, checkpoint_levels=md.sublevels(levels)),
             md.DeFire(2 * ef_start, squeeze_start, int(conv_starts / 2), top_parent=self),
             nn.Dropout2d(),
         )
 
     def forward(self, x):
-        shape = x.shape
-        over = shape[-1] % self.reduce
-        if over:
-            over = self.reduce - over
-            x = F.pad(x, (int(over / 2), int(over / 2), 0, 0), 'replicate')
-        pre_add = self.start(x)
-        insides = self.rest(pre_add)
+        x = md.pad_width(x, self.reduce)
+        pre_add = md.recompute(self.start, x, self.checkpoint)
+        pool, squeeze, defire, dropout = self.rest
+        insides = dropout(md.recompute(defire, squeeze(pool(pre_add)), self.checkpoint))
         result = pre_add + insides
         return result
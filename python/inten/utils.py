@@ -163,8 +163,9 @@ def info_fn(reflect, ignore_index=4, num_classes=4):
             intensity = batch['intensity'].detach()
 
             diff = (intensity - pred_value) * (intensity - pred_value)
-            diff[~mask] = 0
-            return torch.tensor([diff.sum(), mask.sum()])
+            diff = diff.masked_fill(~mask, 0)
+            # Stacking keeps the statistics on the device, torch.tensor would copy every element to host
+            return torch.stack((diff.sum().float(), mask.sum().float()))
 
     else:
 
@@ -174,14 +175,14 @@ def info_fn(reflect, ignore_index=4, num_classes=4):
             mask = torch.squeeze(batch['mask'].detach() >= 0, 1)
             label_mask = ~(labels == ignore_index)
             full_mask = mask & label_mask
-            acc = (~(output == labels))[full_mask]
+            acc = (output != labels) & full_mask
             stats = []
             for i in range(num_classes):
-                tp = (output[full_mask & (labels == i)] == i).sum()
-                fp = (labels[full_mask & (output == i)] != i).sum()
-                fn = (output[full_mask & (labels == i)] != i).sum()
+                tp = (full_mask & (labels == i) & (output == i)).sum()
+                fp = (full_mask & (output == i) & (labels != i)).sum()
+                fn = (full_mask & (labels == i) & (output != i)).sum()
                 stats.extend((tp, fp, fn))
-            return torch.tensor([acc.sum(), *stats, full_mask.sum()])
+            return torch.stack((acc.sum(), *stats, full_mask.sum()))
 
     return fn
 
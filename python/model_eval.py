@@ -1,3 +1,4 @@
+import glob
 import os.path as osp
 import sys
 
@@ -11,10 +12,19 @@ if __name__ == '__main__':
     config = ot.io.load_multi_yml(sys.argv[1])
     if 'seed' in config:
         tu.seed_all(config['seed'])
-    cp = ot.checkpoint.load_checkpoint(osp.join(config['base_dir'], config['store_dir'], config['checkpoint']), False)
+    cp_dir = osp.join(config['base_dir'], config['store_dir'])
+    if 'checkpoints' in config:  # Sweep over all checkpoints matching the pattern
+        cp_names = sorted(glob.glob(osp.join(cp_dir, config['checkpoints'])))
+    else:
+        cp_names = [osp.join(cp_dir, config['checkpoint'])]
     runner = inten.data.EvalRunner(config)
-    trn_dataset = data.DataLoader(inten.data.Dataset(config['train']), **config['train_loader'])
-    val_dataset = data.DataLoader(inten.data.Dataset(config['val']), **config['val_loader'])
-    runner.load_checkpoint(cp)
-    runner(trn_dataset, osp.join(config['base_dir'], config['store_dir'], config['base_save'], config['train_save']))
-    runner(val_dataset, osp.join(config['base_dir'], config['store_dir'], config['base_save'], config['val_save']))
+    loader_cls = tu.ThreadDataLoader if config.get('thread_loader', False) else data.DataLoader
+    trn_dataset = loader_cls(inten.data.Dataset(config['train']), **config['train_loader'])
+    val_dataset = loader_cls(inten.data.Dataset(config['val']), **config['val_loader'])
+    for cp_name, cp in zip(cp_names, ot.checkpoint.iter_checkpoints(cp_names, config.get('load_workers', 4), tu.load_checkpoint_file)):
+        save_dir = osp.join(cp_dir, config['base_save'])
+        if 'checkpoints' in config:
+            save_dir = osp.join(save_dir, osp.splitext(osp.basename(cp_name))[0])
+        runner.load_checkpoint(cp)
+        runner(trn_dataset, osp.join(save_dir, config['train_save']))
+        runner(val_dataset, osp.join(save_dir, config['val_save']))
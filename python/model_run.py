@@ -1,5 +1,7 @@
+import os
 import sys
 
+import torch
 import torch.utils.data as data
 
 import inten
@@ -8,17 +10,34 @@ import torchutils as tu
 
 if __name__ == '__main__':
     config = ot.io.load_multi_yml(sys.argv[1])
+    # Started by torchrun, every process trains on its own part of the data
+    rank, world_size = tu.init_distributed(config.get('dist_backend', 'gloo'))
+    if world_size > 1 and torch.device(config['device']).type == 'cuda':
+        config['device'] = f'cuda:{os.environ.get("LOCAL_RANK", 0)}'
+        torch.cuda.set_device(config['device'])
     if 'seed' in config:
         tu.seed_all(config['seed'])
     runner = inten.data.Runner(config)
-    trn_dataset = data.DataLoader(inten.data.Dataset(config['train']), **config['train_loader'])
-    val_dataset = data.DataLoader(inten.data.Dataset(config['val']), **config['val_loader'])
+    loader_cls = tu.ThreadDataLoader if config.get('thread_loader', False) else data.DataLoader
+    loaders = []
+    for part in ('train', 'val'):
+        dataset = inten.data.Dataset(config[part])
+        loader_kwargs = dict(config[part + '_loader'])
+        if world_size > 1:
+            loader_kwargs['sampler'] = data.DistributedSampler(dataset, shuffle=loader_kwargs.pop('shuffle', False), seed=config.get('seed', 0))
+        loaders.append(loader_cls(dataset, **loader_kwargs))
+    trn_dataset, val_dataset = loaders
     if 'scheduler' in config:
         scheduler = inten.utils.scheduler(config['scheduler'], runner.optimizer)
     else:
         scheduler = None
-    for _ in range(config['epochs']):
+    for epoch in range(config['epochs']):
+        for loader in loaders:
+            if isinstance(loader.sampler, data.DistributedSampler):
+                loader.sampler.set_epoch(epoch)
         trn_loss = runner(trn_dataset, tu.TorchMode.TRAIN)
         val_loss = runner(val_dataset, tu.TorchMode.EVAL)
         if scheduler is not None:
             scheduler.step(val_loss)
+    runner.close()
+    tu.destroy_distributed()
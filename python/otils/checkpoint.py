@@ -1,4 +1,6 @@
 import atexit
+import collections
+import concurrent.futures as cf
 import datetime
 import importlib
 import inspect
@@ -65,7 +67,35 @@ def store_checkpoint(
         _add_bytes_to_tarfile(tarf, dill.dumps(data), _DATA_TAR_NAME)
 
 
+def _data_location(filename):
+    with tf.open(filename, 'r') as tarf:  # Reads only member headers
+        member = tarf.getmember(_DATA_TAR_NAME)
+    return member.offset_data
+
+
+def load_checkpoint_data(filename):
+    '''Loads only the stored data, without extracting or reloading any stored modules'''
+    offset = _data_location(filename)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return dill.load(f)  # nosec
+
+
+def iter_checkpoints(filenames, num_workers=4, loader=load_checkpoint_data):
+    '''Yields data of the checkpoints in order, while decoding up to num_workers of the following ones in parallel'''
+    with cf.ThreadPoolExecutor(num_workers) as pool:
+        futures: typing.Deque[cf.Future] = collections.deque()
+        for filename in filenames:
+            futures.append(pool.submit(loader, filename))
+            if len(futures) > num_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
 def load_checkpoint(filename, reload_modules=True):
+    if not reload_modules:
+        return load_checkpoint_data(filename)
     dirname = tempfile.mkdtemp()
     sys.path.insert(0, dirname)
     atexit.register(shutil.rmtree, dirname, ignore_errors=True)  # Make sure to delete loaded modules
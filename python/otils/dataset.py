@@ -172,9 +172,10 @@ class Dataset:
         self.num_files = self.num_files.num_files
         if 'width' not in self.entry_kwargs:
             self.entry_kwargs['width'] = math.ceil(math.log10(self.num_files + 1))
-        for name, item in self.base_entry.__dict__.items():
-            if isinstance(item, DataAttrib):
-                setattr(self, name, DataAttribIter(self, item))
+        for klass in reversed(self.base_entry.__mro__):  # Overridden attributes of subclasses take precedence
+            for name, item in vars(klass).items():
+                if isinstance(item, DataAttrib):
+                    setattr(self, name, DataAttribIter(self, item))
 
     def __len__(self):
         return self.num_files
@@ -1,4 +1,6 @@
+import concurrent.futures as cf
 import json
+import os
 import os.path as osp
 import types
 
@@ -32,6 +34,56 @@ def np_load(filename):
     return arr
 
 
+class ShardReader:
+    '''
+    Random access to tar shards described by a json index (list of [shard name, {kind: [offset, size]}]).
+    Reads are positioned, so one reader can be shared by many threads.
+    '''
+
+    def __init__(self, dirname, index_name='index.json'):
+        self.dirname = dirname
+        self.index = read_json(osp.join(dirname, index_name))
+        self._fds = dict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _fd(self, shard):
+        fd = self._fds.get(shard, None)
+        if fd is None:
+            fd = os.open(osp.join(self.dirname, shard), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            fd = self._fds.setdefault(shard, fd)
+        return fd
+
+    def read(self, data_id, kind):
+        shard, entries = self.index[data_id]
+        offset, size = entries[kind]
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd(shard), size, offset)
+        with open(osp.join(self.dirname, shard), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def read_many(self, keys, num_workers=4):
+        with cf.ThreadPoolExecutor(num_workers) as pool:
+            return list(pool.map(lambda key: self.read(*key), keys))
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+_SHARD_READERS = dict()
+
+
+def shard_reader(dirname):
+    reader = _SHARD_READERS.get(dirname, None)
+    if reader is None:
+        reader = _SHARD_READERS[dirname] = ShardReader(dirname)
+    return reader
+
+
 def _include(loader, node):
     filename = osp.join(osp.dirname(loader.stream.name), loader.construct_scalar(node))
     with open(filename, 'r') as f:
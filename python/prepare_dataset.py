@@ -54,6 +54,14 @@ def parse_args():
         default=None,
         help='Number of processes to launch. If left at None, it wiill default to half of available CPUs',
     )
+    parser.add_argument(
+        '-of',
+        '--output_format',
+        type=str,
+        default=None,
+        choices=['files', 'shards'],
+        help='Store each snapshot as separate files, or pack each scene into a single indexed tar shard. Defaults to files',
+    )
     parser.add_argument('-lf', '--log_file', type=str, default=None, help='Log file from managed GTA plugin. It helps to correct malformed data.')
     needs_all = parser.add_mutually_exclusive_group()
     needs_all.add_argument('-na', '--needs_all', default=None, action='store_true', help='Whether all cameras from one scene are needed')
@@ -73,6 +81,13 @@ def parse_args():
     delete_invalid = parser.add_mutually_exclusive_group()
     delete_invalid.add_argument('-di', '--delete_invalid', default=None, action='store_true', help='Delete invalid entries from database.')
     delete_invalid.add_argument('-ndi', '--not_delete_invalid', default=None, action='store_false', dest='delete_invalid')
+    dry_run = parser.add_mutually_exclusive_group()
+    dry_run.add_argument(
+        '-cdr', '--cleanup_dry_run', default=None, action='store_true', help='Only report which snapshots and files would be deleted'
+    )
+    dry_run.add_argument('-ncdr', '--not_cleanup_dry_run', default=None, action='store_false', dest='cleanup_dry_run')
+    parser.add_argument('-cb', '--cleanup_batch', type=int, default=None, help='Number of snapshots deleted from database in one transaction')
+    parser.add_argument('-ct', '--cleanup_threads', type=int, default=None, help='Number of threads removing original files')
     verbose = parser.add_mutually_exclusive_group()
     verbose.add_argument('-v', '--verbose', default=None, action='store_true', help='Verbose output')
     verbose.add_argument('-nv', '--not_verbose', default=None, action='store_false', dest='verbose')
@@ -96,15 +111,28 @@ def parse_args():
     parsed = process_field(parsed, yaml_config, 'in_dir')
     parsed = process_field(parsed, yaml_config, 'num_cameras', fail=False)
     parsed = process_field(parsed, yaml_config, 'num_processes', fail=False)
+    parsed = process_field(parsed, yaml_config, 'output_format', fail=False)
     parsed = process_field(parsed, yaml_config, 'needs_all')
     parsed = process_field(parsed, yaml_config, 'all_runs')
     parsed = process_field(parsed, yaml_config, 'log_file')
     parsed = process_field(parsed, yaml_config, 'delete_originals')
     parsed = process_field(parsed, yaml_config, 'delete_invalid')
+    parsed = process_field(parsed, yaml_config, 'cleanup_dry_run', fail=False)
+    parsed = process_field(parsed, yaml_config, 'cleanup_batch', fail=False)
+    parsed = process_field(parsed, yaml_config, 'cleanup_threads', fail=False)
     parsed = process_field(parsed, yaml_config, 'runs', fail=not parsed.all_runs)
 
     if parsed.num_processes is None:
         parsed.num_processes = int(psutil.cpu_count() / 2)
+    if parsed.output_format is None:
+        parsed.output_format = 'files'
+    if parsed.cleanup_dry_run is None:
+        parsed.cleanup_dry_run = False
+    if parsed.cleanup_batch is None:
+        parsed.cleanup_batch = 1000
+    if parsed.cleanup_threads is None:
+        parsed.cleanup_threads = 8
+    parsed.pending_deletes = None
 
     return parsed
 
@@ -0,0 +1,62 @@
+import argparse
+import itertools as it
+import time
+
+import torch
+import torch.utils.data as data
+
+import inten
+import otils as ot
+import torchutils as tu
+
+
+def model_inputs(loader, pass_keys, batches):
+    '''Concatenated input channels and full batches of the first batches of loader'''
+    for batch in it.islice(loader, batches):
+        yield torch.cat([batch[key] for key in pass_keys], 1), batch
+
+
+def evaluate(model, loader, pass_keys, batches, info_fn):
+    '''Mean squared error of info_fn and milliseconds per batch'''
+    info = None
+    elapsed = 0.0
+    done = 0
+    with torch.no_grad():
+        for inputs, batch in model_inputs(loader, pass_keys, batches):
+            start = time.perf_counter()
+            output = model(inputs)
+            elapsed += time.perf_counter() - start
+            done += 1
+            batch_info = info_fn(batch, output)
+            info = batch_info if info is None else info + batch_info
+    if not done:
+        raise ValueError('No batches to evaluate, the val loader is empty!')
+    return (info[0] / info[-1]).item(), 1000 * elapsed / done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantizes a trained model to int8 for cpu inference and reports its accuracy')
+    parser.add_argument('config', help='Evaluation config of the model, its train data are used for calibration and val data for the report')
+    parser.add_argument('output', help='Quantized model stored as TorchScript (.pt), usable by infer_intensity.py -e')
+    parser.add_argument('-w', '--weights', required=True, help='State dict (.pt) or checkpoint of the model')
+    parser.add_argument('-c', '--calibration-batches', type=int, default=16)
+    parser.add_argument('-e', '--eval-batches', type=int, default=16, help='Batches of val data for the accuracy report, 0 skips it')
+    parser.add_argument('--backend', choices=inten.quantize.QUANTIZATION_BACKENDS, default='x86')
+    args = parser.parse_args()
+    config = ot.io.load_multi_yml(args.config)
+    if 'seed' in config:
+        tu.seed_all(config['seed'])
+    model = inten.infer.load_model(config, args.weights, 'cpu')
+    calib_loader = data.DataLoader(inten.data.Dataset(config['train']), **config['train_loader'])
+    calibration = [inputs for inputs, _ in model_inputs(calib_loader, config['pass_keys'], args.calibration_batches)]
+    quantized = inten.quantize.quantize_static(model, calibration, args.backend)
+    _, channels, height, width = calibration[0].shape
+    inten.export.export_model(quantized, args.output, channels, height, width, fuse=False)
+    print(f'Model quantized on {len(calibration)} batches for {channels}x{height}x{width} grids stored to {args.output}')
+    if args.eval_batches:
+        val_loader = data.DataLoader(inten.data.Dataset(config['val']), **config['val_loader'])
+        info_fn = inten.utils.info_fn(**config['info_fn'])
+        print(f'{"model":>6}\t{"mean error":>10}\t{"ms/batch":>8}')
+        for name, runnable in (('fp32', model), ('int8', quantized)):
+            error, latency = evaluate(runnable, val_loader, config['pass_keys'], args.eval_batches, info_fn)
+            print(f'{name:>6}\t{error:10.6f}\t{latency:8.1f}')
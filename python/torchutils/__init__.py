@@ -3,8 +3,11 @@ import types as _types
 
 import otils as _ou
 
+from ._checkpoint import *  # noqa: F403,F401
 from ._data import *  # noqa: F403,F401
+from ._distributed import *  # noqa: F403,F401
 from ._modules import *  # noqa: F403,F401
+from ._profile import *  # noqa: F403,F401
 from ._registry import *  # noqa: F403,F401
 from ._utils import *  # noqa: F403,F401
 
@@ -0,0 +1,143 @@
+import collections
+import concurrent.futures as cf
+import json
+import os
+import struct
+import typing
+
+import numpy as np
+import torch
+
+import otils as ot
+
+TENSOR_CHECKPOINT_EXT = '.tensors'
+_ALIGN = 64
+_HEADER_LEN = struct.Struct('<Q')
+
+
+def _align(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+
+def _encode(data, tensors, path='data'):
+    '''Replaces tensors in nested containers by references and copies them to host memory'''
+    if isinstance(data, torch.Tensor):
+        name = path if path not in tensors else f'{path}#{len(tensors)}'
+        tensors[name] = data.detach().to('cpu', copy=True).contiguous()
+        return {'__tensor__': name}
+    if isinstance(data, typing.Mapping):
+        return {'__dict__': [[_encode(key, tensors, path), _encode(value, tensors, f'{path}/{key}')] for key, value in data.items()]}
+    if isinstance(data, tuple):
+        return {'__tuple__': [_encode(value, tensors, f'{path}/{i}') for i, value in enumerate(data)]}
+    if isinstance(data, list):
+        return [_encode(value, tensors, f'{path}/{i}') for i, value in enumerate(data)]
+    if isinstance(data, np.generic):
+        return data.item()
+    if data is None or isinstance(data, (bool, int, float, str)):
+        return data
+    raise TypeError(f'Cannot store {type(data).__name__} in a tensor checkpoint!')
+
+
+def _decode(data, tensors):
+    if isinstance(data, list):
+        return [_decode(value, tensors) for value in data]
+    if isinstance(data, dict):
+        if '__tensor__' in data:
+            return tensors[data['__tensor__']]
+        if '__tuple__' in data:
+            return tuple(_decode(value, tensors) for value in data['__tuple__'])
+        return {_decode(key, tensors): _decode(value, tensors) for key, value in data['__dict__']}
+    return data
+
+
+def _write_tensor_checkpoint(filename, skeleton, tensors):
+    table = dict()
+    offset = 0
+    for name, tensor in tensors.items():
+        offset = _align(offset)
+        nbytes = tensor.numel() * tensor.element_size()
+        table[name] = {'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.shape), 'offset': offset, 'nbytes': nbytes}
+        offset += nbytes
+    header = json.dumps({'tensors': table, 'data': skeleton}).encode('utf-8')
+    header += b' ' * (_align(len(header) + _HEADER_LEN.size) - len(header) - _HEADER_LEN.size)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        start = f.tell()
+        for name, tensor in tensors.items():
+            f.seek(start + table[name]['offset'])
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+    os.replace(tmpname, filename)
+
+
+def store_tensor_checkpoint(filename, data):
+    '''Stores nested containers of tensors and plain values as a json header followed by aligned raw tensor data'''
+    tensors: typing.Dict[str, torch.Tensor] = dict()
+    skeleton = _encode(data, tensors)
+    _write_tensor_checkpoint(filename, skeleton, tensors)
+
+
+def load_tensor_checkpoint(filename, mmap=True):
+    '''Loads checkpoint stored by store_tensor_checkpoint. With mmap, tensors are copy-on-write views of the file'''
+    with open(filename, 'rb') as f:
+        (header_len,) = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    start = _HEADER_LEN.size + header_len
+    if mmap:
+        buffer = torch.from_numpy(np.memmap(filename, dtype=np.uint8, mode='c'))
+    else:
+        buffer = torch.from_numpy(np.fromfile(filename, dtype=np.uint8))
+    tensors = dict()
+    for name, entry in header['tensors'].items():
+        begin = start + entry['offset']
+        tensors[name] = buffer[begin : begin + entry['nbytes']].view(getattr(torch, entry['dtype'])).reshape(entry['shape'])
+    return _decode(header['data'], tensors)
+
+
+def load_checkpoint_file(filename):
+    if filename.endswith(TENSOR_CHECKPOINT_EXT):
+        return load_tensor_checkpoint(filename)
+    return ot.checkpoint.load_checkpoint_data(filename)
+
+
+class AsyncCheckpointer:
+    '''
+    Stores tensor checkpoints in a background thread. Saving blocks only for the copy of tensors to host memory,
+    and for the previous write, if it is still running.
+    Retention keeps keep_last latest checkpoints and every checkpoint with (step + 1) divisible by keep_every.
+    '''
+
+    def __init__(self, keep_last: typing.Optional[int] = None, keep_every: typing.Optional[int] = None):
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self._pool = cf.ThreadPoolExecutor(1)
+        self._pending: typing.Optional[cf.Future] = None
+        self._stored: typing.Deque[typing.Tuple[str, typing.Optional[int]]] = collections.deque()
+
+    def save(self, filename, data, step=None):
+        tensors: typing.Dict[str, torch.Tensor] = dict()
+        skeleton = _encode(data, tensors)
+        self.wait()
+        self._pending = self._pool.submit(self._store, filename, skeleton, tensors, step)
+
+    def _store(self, filename, skeleton, tensors, step):
+        _write_tensor_checkpoint(filename, skeleton, tensors)
+        self._stored.append((filename, step))
+        if self.keep_last is None:
+            return
+        while len(self._stored) > self.keep_last:
+            old_name, old_step = self._stored.popleft()
+            if self.keep_every and old_step is not None and (old_step + 1) % self.keep_every == 0:
+                continue
+            if old_name != filename:
+                os.remove(old_name)
+
+    def wait(self):
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
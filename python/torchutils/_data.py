@@ -1,12 +1,21 @@
 import argparse
+import atexit
 import builtins
 import collections
+import concurrent.futures as cf
 import contextlib
 import enum
 import functools
+import itertools as it
+import multiprocessing as mp
 import os.path as osp
+import pickle  # nosec
+import queue
 import random
+import threading
+import typing
 import weakref
+from multiprocessing import shared_memory
 
 import numpy as np
 import torch
@@ -20,6 +29,9 @@ try:
 except ImportError:
     _TQDM_FOUND = False
 
+from ._distributed import all_reduce_sum, is_main_process, no_sync, unwrap_model, wrap_distributed
+from ._profile import ModuleProfiler
+
 
 builtins.print = functools.partial(print, flush=True)
 
@@ -28,6 +40,93 @@ def _compose(*functions):
     return functools.reduce(lambda f, g: lambda x: f(g(x)), functions, lambda x: x)
 
 
+_SharedArray = collections.namedtuple('_SharedArray', ['dtype', 'shape', 'offset'])
+
+
+class SharedCache:
+    '''
+    Sample cache in shared memory, filled by whichever DataLoader worker loads a sample first and read by all of them
+    without copying. Samples are dicts of numpy arrays and picklable values, stored in a preallocated arena of
+    capacity bytes. Once the arena is full, further samples are not admitted and are loaded from disk as usual:
+    with every epoch visiting samples in a new random order, replacing cached samples cannot raise the hit rate
+    above capacity / dataset size, and it would invalidate arrays that other workers are still reading.
+    Workers have to be forked from the process that created the cache.
+    '''
+
+    EMPTY, WRITING, READY, REJECTED = range(4)
+    ALIGN = 64
+
+    def __init__(self, num_items, capacity):
+        self.capacity = int(capacity)
+        self._arena = shared_memory.SharedMemory(create=True, size=max(self.capacity, 1))
+        self._index_mem = shared_memory.SharedMemory(create=True, size=max(num_items * 3 * 8, 1))
+        self._index = np.ndarray((num_items, 3), dtype='<i8', buffer=self._index_mem.buf)
+        self._index[:] = 0
+        self._used = mp.Value('q', 0, lock=False)
+        self._lock = mp.Lock()
+        self._owner = mp.current_process().pid
+        atexit.register(self.close)
+
+    def _align(self, size):
+        return -(-size // self.ALIGN) * self.ALIGN
+
+    def get(self, key):
+        if self._index[key, 0] != self.READY:
+            return None
+        offset, header_len = self._index[key, 1:]
+        header = pickle.loads(self._arena.buf[offset : offset + header_len])  # nosec
+        start = offset + self._align(header_len)
+        result = dict()
+        for name, value in header.items():
+            if isinstance(value, _SharedArray):
+                value = np.ndarray(value.shape, dtype=value.dtype, buffer=self._arena.buf, offset=start + value.offset)
+            result[name] = value
+        return result
+
+    def put(self, key, item):
+        header = dict()
+        arrays = []
+        size = 0
+        for name, value in item.items():
+            if isinstance(value, np.ndarray):
+                size = self._align(size)
+                arrays.append((size, value))
+                header[name] = _SharedArray(value.dtype.str, value.shape, size)
+                size += value.nbytes
+            else:
+                header[name] = value
+        header_bytes = pickle.dumps(header)
+        start = self._align(len(header_bytes))
+        with self._lock:
+            if self._index[key, 0] != self.EMPTY:
+                return
+            offset = self._used.value
+            if offset + start + size > self.capacity:
+                self._index[key, 0] = self.REJECTED
+                return
+            self._used.value = self._align(offset + start + size)
+            self._index[key, 0] = self.WRITING
+        self._arena.buf[offset : offset + len(header_bytes)] = header_bytes
+        for array_offset, value in arrays:
+            target = np.ndarray(value.shape, dtype=value.dtype, buffer=self._arena.buf, offset=offset + start + array_offset)
+            target[...] = value
+        self._index[key, 1:] = offset, len(header_bytes)
+        self._index[key, 0] = self.READY
+
+    def close(self):
+        if self._index is None:
+            return
+        self._index = None
+        try:
+            self._arena.close()
+            self._index_mem.close()
+        except BufferError:  # Some arrays are still referenced, the memory gets released with the process
+            pass
+        if mp.current_process().pid == self._owner:
+            self._arena.unlink()
+            self._index_mem.unlink()
+
+
 class SimpleDataset(data.Dataset):
     class weakdict(dict):
         __slots__ = ('__weakref__',)
@@ -35,7 +134,7 @@ class SimpleDataset(data.Dataset):
     class weaklist(list):
         __slots__ = ('__weakref__',)
 
-    def __init__(self, folder: str, name=None, ext='.npy', shuffle=True, keep_ram=False):
+    def __init__(self, folder: str, name=None, ext='.npy', shuffle=True, keep_ram=False, shared_cache=None):
         self.folder = folder
         self.ext = ext.lower()
         if name is None:
@@ -50,6 +149,10 @@ class SimpleDataset(data.Dataset):
             self.loaded = dict()
         else:
             self.loaded = weakref.WeakValueDictionary()
+        if shared_cache:
+            self.shared = SharedCache(self._len, shared_cache)
+        else:
+            self.shared = None
 
     def __len__(self):
         return self._len
@@ -57,29 +160,194 @@ class SimpleDataset(data.Dataset):
     def __getitem__(self, key):
         key = int(key)
         fname = self.files[key]
+        if self.shared is not None:
+            data_item = self.shared.get(key)
+            if data_item is None:
+                data_item = self.load_and_transform(fname, key)
+                self.shared.put(key, data_item)
+            return data_item
         data_item = self.loaded.get(fname, None)
         if data_item is None:
-            with self.__weakcm():
-                data_item = self.load_and_transform(fname, key)
+            data_item = self.load_and_transform(fname, key)
+            if not self.keep_ram:
+                data_item = self._weak_referable(data_item)
             self.loaded[fname] = data_item
         return data_item
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if not self.keep_ram:
+            state['loaded'] = None  # Weak dictionaries cannot be pickled, and their content is not worth it
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.loaded is None:
+            self.loaded = weakref.WeakValueDictionary()
+
     def load_and_transform(self, fname, key):
         raise NotImplementedError
 
     def scan_files(self):
         raise NotImplementedError
 
-    @contextlib.contextmanager
-    def __weakcm(self):
-        if not self.keep_ram:
-            _stash = dict, list
-            builtins.dict = self.weakdict
-            builtins.list = self.weaklist
-            yield
-            builtins.dict, builtins.list = _stash
-        else:
-            yield
+    @classmethod
+    def _weak_referable(cls, data_item):
+        if isinstance(data_item, dict) and not isinstance(data_item, cls.weakdict):
+            return cls.weakdict(data_item)
+        if isinstance(data_item, list) and not isinstance(data_item, cls.weaklist):
+            return cls.weaklist(data_item)
+        return data_item
+
+
+def _pin_memory(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, dict):
+        return type(batch)((key, _pin_memory(value)) for key, value in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin_memory(value) for value in batch)
+    return batch
+
+
+class ThreadDataLoader:
+    '''
+    Replacement of DataLoader, which loads samples by a pool of threads within the main process.
+    Up to prefetch batches are being loaded ahead, samples are collated in the order of the sampler.
+    '''
+
+    def __init__(
+        self, dataset, batch_size=1, shuffle=False, sampler=None, num_workers=0, pin_memory=False, drop_last=False, collate_fn=None, prefetch=2
+    ):
+        self.dataset = dataset
+        if sampler is None:
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+        self.sampler = sampler
+        self.batch_sampler = data.BatchSampler(sampler, batch_size, drop_last)
+        self.num_workers = max(num_workers, 1)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.collate_fn = collate_fn if collate_fn is not None else data.dataloader.default_collate
+        self.prefetch = max(prefetch, 1)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        with cf.ThreadPoolExecutor(self.num_workers) as pool:
+            pending: typing.Deque[typing.List[cf.Future]] = collections.deque()
+            for indices in it.islice(batches, self.prefetch):
+                pending.append([pool.submit(self.dataset.__getitem__, i) for i in indices])
+            while pending:
+                futures = pending.popleft()
+                for indices in it.islice(batches, 1):
+                    pending.append([pool.submit(self.dataset.__getitem__, i) for i in indices])
+                batch = self.collate_fn([future.result() for future in futures])
+                if self.pin_memory:
+                    batch = _pin_memory(batch)
+                yield batch
+
+
+def _to_device(batch, device):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return type(batch)((key, _to_device(value, device)) for key, value in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(value, device) for value in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            _record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            _record_stream(value, stream)
+
+
+class BatchPrefetcher:
+    '''
+    Iterates over loader, while the following batches are loaded by a background thread.
+    With a CUDA device, the thread also pins the batches and they are copied to the device on a side stream,
+    so the copy of the next batch overlaps with the computation on the current one.
+    '''
+
+    def __init__(self, loader, device=None, depth=1):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = torch.device(device) if device is not None else None
+        self.depth = max(depth, 1)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device is not None and self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    @staticmethod
+    def _put(out, stop, item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, out, stop, prepare):
+        try:
+            for batch in self.loader:
+                if prepare is not None:
+                    batch = prepare(batch)
+                if not self._put(out, stop, (True, batch)):
+                    return
+        except Exception as exc:  # pylint: disable=broad-except  # Reraised in the consuming thread
+            self._put(out, stop, (False, exc))
+            return
+        self._put(out, stop, (False, None))
+
+    def _iter_thread(self, prepare=None):
+        out: queue.Queue = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out, stop, prepare), daemon=True)
+        thread.start()
+        try:
+            while True:
+                is_batch, item = out.get()
+                if not is_batch:
+                    if item is not None:
+                        raise item
+                    return
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = self._iter_thread(_pin_memory)
+        staged: typing.Deque = collections.deque()
+
+        def stage(batch):
+            with torch.cuda.stream(stream):
+                return _to_device(batch, self.device)
+
+        for batch in it.islice(batches, self.depth):
+            staged.append(stage(batch))
+        while staged:
+            batch = staged.popleft()
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            _record_stream(batch, current)
+            for following in it.islice(batches, 1):
+                staged.append(stage(following))
+            yield batch
 
 
 class TorchMode(enum.Enum):
@@ -87,6 +355,47 @@ class TorchMode(enum.Enum):
     EVAL = enum.auto()
 
 
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def amp_dtype(amp, device_type):
+    '''Autocast dtype for amp setting, True selects bf16 on cpu and fp16 on accelerators'''
+    if not amp:
+        return None
+    if amp is True:
+        return torch.bfloat16 if device_type == 'cpu' else torch.float16
+    if amp not in AMP_DTYPES:
+        raise ValueError(f'Unknown mixed precision mode {amp}, use one of {list(AMP_DTYPES)}!')
+    if device_type == 'cpu' and amp != 'bf16':
+        raise ValueError('Only bf16 mixed precision is supported on cpu!')
+    return AMP_DTYPES[amp]
+
+
+def _to_float(data):
+    if isinstance(data, torch.Tensor):
+        return data.float() if data.is_floating_point() else data
+    if isinstance(data, dict):
+        return type(data)((key, _to_float(value)) for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return type(data)(_to_float(value) for value in data)
+    return data
+
+
+def _slice_batch(batch, start, stop):
+    return type(batch)((key, value[start:stop] if isinstance(value, (torch.Tensor, list, tuple)) else value) for key, value in batch.items())
+
+
+def _cat_outputs(outputs):
+    first = outputs[0]
+    if isinstance(first, torch.Tensor):
+        return torch.cat([output.detach() for output in outputs], 0)
+    if isinstance(first, dict):
+        return type(first)((key, _cat_outputs([output[key] for output in outputs])) for key in first)
+    if isinstance(first, (list, tuple)):
+        return type(first)(_cat_outputs(values) for values in zip(*outputs))
+    return first
+
+
 def dict_to_cuda(d, *args, **kwargs):
     for key in d:
         if hasattr(d[key], 'cuda'):
@@ -110,14 +419,17 @@ class Runner:
         accum_losses=False,
         pass_as_kwargs=False,
         cat_channels=False,
+        log_interval=10,
+        aux_keys=None,
     ):
         self.model = model
         self.loss_fn = loss_fn
         self.optimizer = optimizer
         self.pass_keys = pass_keys
         self.gt_keys = gt_keys
-        self.verbose = verbose
-        self.use_tqdm = use_tqdm & _TQDM_FOUND
+        self.aux_keys = aux_keys if aux_keys is not None else []  # Always passed as keyword arguments, never concatenated
+        self.verbose = verbose and is_main_process()
+        self.use_tqdm = use_tqdm & _TQDM_FOUND & is_main_process()
         self.embedder = embedder
         self.embed_channel = embed_channel
         if args is None:
@@ -131,16 +443,107 @@ class Runner:
             self.keep_ram = args.keep_ram
         except AttributeError:
             self.keep_ram = False
+        try:
+            self.prefetch = args.prefetch
+        except AttributeError:
+            self.prefetch = False
+        try:
+            self.accumulate_steps = max(1, args.accumulate_steps)
+        except AttributeError:
+            self.accumulate_steps = 1
+        try:
+            self.micro_batch = args.micro_batch
+        except AttributeError:
+            self.micro_batch = None
+        try:
+            self.amp = args.amp
+        except AttributeError:
+            self.amp = None
+        try:
+            self.channels_last = args.channels_last
+        except AttributeError:
+            self.channels_last = False
+        try:
+            profile = args.profile
+        except AttributeError:
+            profile = None
+        self.device_type = 'cuda' if self.cuda else 'cpu'
+        self.amp_dtype = amp_dtype(self.amp, self.device_type)
+        # Loss scaling is needed only for fp16, for other dtypes the scaler just calls backward and step
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.amp_dtype is torch.float16)
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        if self.optimizer is not None:
+            self.model = wrap_distributed(self.model)
+            if self.embedder is not None:
+                self.embedder = wrap_distributed(self.embedder)
+        # Per module times, FLOPs and memory, e.g. profile: {types: [Fire, DeFire], batches: 10, json_file: ..., trace_file: ...}
+        self.profiler = ModuleProfiler(unwrap_model(self.model), **profile) if profile else None
         if self.use_tqdm:
             self.iter_wrap = tqdm.tqdm
         else:
-            self.iter_wrap = functools.partial(map, lambda x, *args, **kwargs: x)
+            self.iter_wrap = lambda x, *args, **kwargs: x
         self.pass_as_kwargs = pass_as_kwargs
         self.accum_losses = accum_losses
+        self.log_interval = max(1, log_interval)
         self.run_times = collections.Counter()
-        self.run_losses = dict()
+        self.loss_sums = dict()
+        self.loss_batches = dict()
         self.cat_channels = cat_channels
 
+    def _forward(self, batch):
+        with torch.autocast(self.device_type, self.amp_dtype, enabled=self.amp_dtype is not None):
+            if self.embedder is not None:
+                batch[self.embed_channel + '_embed'] = self.embedder(batch[self.embed_channel])
+            run_kwargs = collections.OrderedDict((key, self._memory_format(batch[key])) for key in self.pass_keys)
+            aux_kwargs = {key: batch[key] for key in self.aux_keys if key in batch}
+            if self.cat_channels:
+                output = self.model(torch.cat(tuple(run_kwargs.values()), 1), **aux_kwargs)
+            elif self.pass_as_kwargs:
+                output = self.model(**run_kwargs, **aux_kwargs)
+            else:
+                output = self.model(*run_kwargs.values(), **aux_kwargs)
+        if self.amp_dtype is not None:
+            output = _to_float(output)
+        return output
+
+    def _run_batch(self, batch, batch_len, mode, cycle_len, step=False):
+        '''
+        Runs the batch in micro batches of at most micro_batch samples, with gradients accumulated over cycle_len batches.
+        Losses of micro batches are weighted by their share of samples, BatchNorm statistics are computed per micro batch.
+        Gradients are synchronised between processes only in the last backward pass before a step.
+        '''
+        if self.micro_batch is None or self.micro_batch >= batch_len:
+            chunks = [batch]
+        else:
+            chunks = [_slice_batch(batch, start, start + self.micro_batch) for start in range(0, batch_len, self.micro_batch)]
+        outputs = []
+        loss = None
+        for chunk_id, chunk in enumerate(chunks):
+            with contextlib.nullcontext() if step and chunk_id + 1 == len(chunks) else no_sync(self.model, self.embedder):
+                output = self._forward(chunk)
+                outputs.append(output)
+                if mode != TorchMode.TRAIN and not all([key in chunk for key in self.gt_keys]):
+                    continue
+                loss_kwargs = collections.OrderedDict((key, chunk[key]) for key in self.gt_keys)
+                if self.pass_as_kwargs:
+                    chunk_loss = self.loss_fn(output, **loss_kwargs)
+                else:
+                    chunk_loss = self.loss_fn(output, *loss_kwargs.values())
+                if len(chunks) > 1:
+                    chunk_loss = chunk_loss * (len(next(iter(chunk.values()))) / batch_len)
+                if mode == TorchMode.TRAIN:
+                    self.scaler.scale(chunk_loss / cycle_len).backward()
+                loss = chunk_loss.detach() if loss is None else loss + chunk_loss.detach()
+        if len(chunks) == 1:
+            return outputs[0], loss
+        return _cat_outputs(outputs), loss
+
+    def _memory_format(self, data):
+        if self.channels_last and isinstance(data, torch.Tensor) and data.dim() == 4:
+            return data.contiguous(memory_format=torch.channels_last)
+        return data
+
     @contextlib.contextmanager
     def _setup(self):
         _stash = builtins.print
@@ -152,55 +555,59 @@ class Runner:
         builtins.print = _stash
 
     def __call__(self, dataloader, mode):
-        datalen = len(dataloader.dataset)
+        try:
+            datalen = len(dataloader.sampler)  # Part of the dataset of this process, when distributed
+        except (AttributeError, TypeError):
+            datalen = len(dataloader.dataset)
         did = 0
         self.model = self.model.train() if mode is TorchMode.TRAIN else self.model.eval()
         self.run_pre_epoch(dataloader.dataset, mode)
         if self.accum_losses:
-            self.run_losses[dataloader.dataset] = list()
+            # A tensor also on processes without batches, so all of them join the reduction of the same dtype
+            self.loss_sums[dataloader.dataset] = torch.zeros((), device='cuda' if self.cuda else None)
+            self.loss_batches[dataloader.dataset] = 0
         with self._setup():
             with torch.set_grad_enabled(mode == TorchMode.TRAIN):
-                for batch_id, batch in self.iter_wrap(enumerate(dataloader), total=len(dataloader)):
+                loader = BatchPrefetcher(dataloader, 'cuda' if self.cuda else None) if self.prefetch else dataloader
+                cycle_len = 1
+                for batch_id, batch in self.iter_wrap(enumerate(loader), total=len(loader)):
                     batch_len = len(next(iter(batch.values())))
                     did += batch_len
-                    if self.cuda:
+                    if self.profiler is not None:
+                        self.profiler.start_batch(batch_id)
+                    if self.cuda and not self.prefetch:
                         dict_to_cuda(batch, **({'non_blocking': True} if self.keep_ram else {}))
-                    if mode == TorchMode.TRAIN:
+                    if mode == TorchMode.TRAIN and batch_id % self.accumulate_steps == 0:
                         self.optimizer.zero_grad()
-                    if self.embedder is not None:
-                        batch[self.embed_channel + '_embed'] = self.embedder(batch[self.embed_channel])
-                    run_kwargs = collections.OrderedDict((key, batch[key]) for key in self.pass_keys)
-                    if self.cat_channels:
-                        output = self.model(torch.cat(tuple(run_kwargs.values()), 1))
-                    elif self.pass_as_kwargs:
-                        output = self.model(**run_kwargs)
-                    else:
-                        output = self.model(*run_kwargs.values())
-                    if mode == TorchMode.TRAIN or all([key in batch for key in self.gt_keys]):
-                        loss_kwargs = collections.OrderedDict((key, batch[key]) for key in self.gt_keys)
-                        if self.pass_as_kwargs:
-                            loss = self.loss_fn(output, **loss_kwargs)
-                        else:
-                            loss = self.loss_fn(output, *loss_kwargs.values())
-                        if mode == TorchMode.TRAIN:
-                            loss.backward()
-                            self.optimizer.step()
-                    else:
-                        loss = None
+                        cycle_len = min(self.accumulate_steps, len(loader) - batch_id)
+                    step = mode == TorchMode.TRAIN and ((batch_id + 1) % self.accumulate_steps == 0 or batch_id + 1 == len(loader))
+                    output, loss = self._run_batch(batch, batch_len, mode, cycle_len if mode == TorchMode.TRAIN else 1, step)
+                    if step:
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                    # Losses stay on the device, they are only read back when the progress is printed
+                    if self.accum_losses and loss is not None:
+                        self.loss_sums[dataloader.dataset] = self.loss_sums[dataloader.dataset] + loss.detach().float() * batch_len
+                        self.loss_batches[dataloader.dataset] += 1
+                    extra = self.run_after_iter(batch, output, loss, mode, did, batch_id, len(dataloader), dataloader.dataset)
+                    if (batch_id + 1) % self.log_interval != 0 and batch_id + 1 != len(dataloader):
+                        continue
                     print_str = f'Epoch id: {self.run_times[dataloader.dataset]}\t{did: 6d} / {datalen : 6d}\t'
                     if loss is not None:
-                        print_str += f'Loss: {loss:8.04f}\t'
-                    if self.accum_losses:
-                        self.run_losses[dataloader.dataset].append(loss.detach() * batch_len)
-                        print_str += f'Mean loss over epoch: {np.sum(self.run_losses[dataloader.dataset])/did: 8.04f}\t'
-                    extra = self.run_after_iter(batch, output, loss, mode, did, batch_id, len(dataloader), dataloader.dataset)
+                        print_str += f'Loss: {loss.item():8.04f}\t'
+                        if self.accum_losses:
+                            print_str += f'Mean loss over epoch: {float(self.loss_sums[dataloader.dataset]) / did: 8.04f}\t'
                     if extra is not None:
                         print_str += str(extra)
                     print(print_str)
+                if self.accum_losses:
+                    self.loss_sums[dataloader.dataset] = all_reduce_sum(self.loss_sums[dataloader.dataset])
                 print_str = f'Epoch {self.run_times[dataloader.dataset]} for dataset {dataloader.dataset} and mode {mode} finished!\n'
                 extra = self.run_after_epoch(dataloader.dataset, mode)
                 if extra is not None:
                     print_str += str(extra)
+                if self.profiler is not None:
+                    print_str += self.profiler.finish(is_main_process(), mode=mode.name.lower(), epoch=self.run_times[dataloader.dataset]) + '\n'
                 print(print_str)
                 self.run_times[dataloader.dataset] += 1
 
@@ -0,0 +1,72 @@
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(backend='gloo'):
+    '''Initializes the default process group from the environment set by torchrun, returns rank and world size'''
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend)
+    return get_rank(), get_world_size()
+
+
+def destroy_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    '''Sum of tensor or number over all processes, every process has to call it with the same dtype, the tensor is left untouched'''
+    if not is_distributed():
+        return tensor
+    if isinstance(tensor, torch.Tensor):
+        tensor = tensor.clone()
+    else:
+        device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else None
+        tensor = torch.as_tensor(tensor, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return tensor
+
+
+def all_reduce_mean(tensor):
+    return all_reduce_sum(tensor) / get_world_size()
+
+
+def wrap_distributed(module):
+    '''Wraps module with trainable parameters in DistributedDataParallel, when running in more processes'''
+    if not is_distributed() or not any(param.requires_grad for param in module.parameters()):
+        return module
+    device = next(module.parameters()).device
+    return DistributedDataParallel(module, device_ids=[device] if device.type == 'cuda' else None)
+
+
+def unwrap_model(module):
+    return module.module if isinstance(module, DistributedDataParallel) else module
+
+
+def no_sync(*modules):
+    '''Context, in which backward passes of wrapped modules only accumulate gradients locally'''
+    stack = contextlib.ExitStack()
+    for module in modules:
+        if isinstance(module, DistributedDataParallel):
+            stack.enter_context(module.no_sync())
+    return stack
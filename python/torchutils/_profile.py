@@ -0,0 +1,265 @@
+import collections
+import contextlib
+import functools
+import itertools as it
+import json
+import math
+import os
+import threading
+import time
+import typing
+
+import torch
+import torch.nn as nn
+from torch.nn.modules.utils import _pair
+
+# Estimates of floating point operations of leaf modules, two per multiply-add
+_FLOPS = collections.OrderedDict(
+    [
+        (nn.Conv2d, lambda module, inputs, output: 2 * output.numel() * module.in_channels // module.groups * math.prod(module.kernel_size)),
+        (
+            nn.ConvTranspose2d,
+            lambda module, inputs, output: 2 * inputs[0].numel() * module.out_channels // module.groups * math.prod(module.kernel_size),
+        ),
+        (nn.Linear, lambda module, inputs, output: 2 * output.numel() * module.in_features),
+        (nn.modules.batchnorm._BatchNorm, lambda module, inputs, output: 2 * output.numel()),
+        (nn.MaxPool2d, lambda module, inputs, output: output.numel() * math.prod(_pair(module.kernel_size))),
+        (nn.ReLU, lambda module, inputs, output: output.numel()),
+        (nn.Sigmoid, lambda module, inputs, output: output.numel()),
+    ]
+)
+
+
+def _flops_fn(module):
+    return next((fn for cls, fn in _FLOPS.items() if isinstance(module, cls)), None)
+
+
+_PAUSED = 0
+
+
+@contextlib.contextmanager
+def no_profiling():
+    '''Forward passes within are not recorded by profilers, e.g. activations recomputed during backward'''
+    global _PAUSED  # pylint: disable=global-statement
+    _PAUSED += 1
+    try:
+        yield
+    finally:
+        _PAUSED -= 1
+
+
+def _tensors(data):
+    if isinstance(data, torch.Tensor):
+        yield data
+    elif isinstance(data, dict):
+        for value in data.values():
+            yield from _tensors(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            yield from _tensors(value)
+
+
+class ModuleProfiler:
+    '''
+    Records wall time of forward and backward passes, estimated FLOPs and bytes of output activations and parameters of modules
+    by hooks. Modules are selected by names of their classes in types and by the depth of their names, both optional.
+    Times, FLOPs and shares of the forward pass are inclusive, nested modules count their submodules too, so the shares do not
+    add up to 100 %. Backward time is measured only for leaf modules with known FLOPs (convolutions, normalizations, ...) and
+    selected leaves, by hooks of the autograd node of their output, and is summed over leaves within a module, so gradients of
+    functional operations between modules are not included. Full backward hooks of modules are not used, as they forbid
+    in-place operations on outputs, e.g. ReLU(inplace=True) after a convolution.
+    Forward passes within no_profiling, e.g. recomputation of checkpointed activations, are not recorded, their time counts to
+    the backward of the leaf whose gradient needs them.
+    Batches warmup to warmup + batches of an epoch are profiled, see start_batch and finish, which prints the table and stores
+    the json report and the Chrome trace (chrome://tracing) to json_file and trace_file formatted by mode and epoch.
+    '''
+
+    def __init__(self, model=None, types=None, depth=None, sync=None, warmup=1, batches=None, json_file=None, trace_file=None):
+        self.types = frozenset(types) if types is not None else None
+        self.depth = depth
+        self.sync = sync
+        self.warmup = warmup
+        self.batches = batches
+        self.json_file = json_file
+        self.trace_file = trace_file
+        self.enabled = True
+        self.param_bytes: typing.Dict[str, int] = dict()
+        self._handles: typing.List[torch.utils.hooks.RemovableHandle] = []
+        self._records: typing.List[dict] = []
+        self._backward: typing.List[dict] = []
+        self._stack: typing.List[dict] = []
+        self._sync = False
+        self._start = time.perf_counter()
+        if model is not None:
+            self.attach(model)
+
+    def _selected(self, name, module):
+        if self.types is not None and type(module).__name__ not in self.types:
+            return False
+        return self.depth is None or (name.count('.') + 1 if name else 0) <= self.depth
+
+    def attach(self, model):
+        '''Hooks modules of model, hooks of previously attached model are removed'''
+        self.detach()
+        self._sync = self.sync if self.sync is not None else any(param.is_cuda for param in model.parameters())
+        for name, module in model.named_modules():
+            selected = self._selected(name, module)
+            leaf = next(module.children(), None) is None
+            flops = _flops_fn(module) if leaf else None
+            if not selected and flops is None:
+                continue
+            name = name or type(module).__name__
+            if selected:
+                self.param_bytes[name] = sum(tensor.numel() * tensor.element_size() for tensor in it.chain(module.parameters(), module.buffers()))
+            self._handles.append(module.register_forward_pre_hook(functools.partial(self._pre_hook, name, selected)))
+            self._handles.append(module.register_forward_hook(functools.partial(self._post_hook, name, selected, flops, leaf)))
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self.param_bytes = dict()
+
+    def reset(self):
+        self._records = []
+        self._backward = []
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def _now(self):
+        if self._sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _pre_hook(self, name, selected, module, inputs):
+        if not self.enabled or not selected or _PAUSED:
+            return
+        record = {'name': name, 'type': type(module).__name__, 'flops': 0, 'thread': threading.get_ident(), 'backward_ms': 0.0, 'backward_calls': 0}
+        record['outermost'] = not self._stack
+        self._stack.append(record)
+        record['start'] = self._now()
+
+    def _post_hook(self, name, selected, flops, leaf, module, inputs, output):
+        if not self.enabled or not self._stack or _PAUSED:
+            return
+        if flops is not None:
+            count = flops(module, inputs, output)
+            for record in self._stack:
+                record['flops'] += count
+        targets = list(self._stack)
+        if selected:
+            end = self._now()
+            record = self._stack.pop()
+            record['end'] = end
+            record['activation_bytes'] = sum(tensor.numel() * tensor.element_size() for tensor in _tensors(output))
+            self._records.append(record)
+        node = next((tensor.grad_fn for tensor in _tensors(output) if tensor.grad_fn is not None), None) if leaf else None
+        if node is not None and torch.is_grad_enabled():
+            call = {'name': name, 'targets': targets}
+            node.register_prehook(functools.partial(self._backward_start, call))
+            node.register_hook(functools.partial(self._backward_end, call))
+
+    def _backward_start(self, call, grad_outputs):
+        call['start'] = self._now()
+
+    def _backward_end(self, call, grad_inputs, grad_outputs):
+        call['end'] = self._now()
+        call['thread'] = threading.get_ident()
+        for record in call['targets']:
+            record['backward_ms'] += 1000 * (call['end'] - call['start'])
+            record['backward_calls'] += 1
+        self._backward.append(call)
+
+    def start_batch(self, batch_id):
+        '''Enables profiling for batches from warmup to warmup + batches'''
+        self.enabled = batch_id >= self.warmup and (self.batches is None or batch_id < self.warmup + self.batches)
+
+    def summary(self):
+        '''Totals per module over the profiled calls, in order of the first call'''
+        rows: typing.Dict[str, dict] = dict()
+        for record in self._records:
+            row = rows.setdefault(
+                record['name'],
+                {
+                    'name': record['name'],
+                    'type': record['type'],
+                    'calls': 0,
+                    'forward_ms': 0.0,
+                    'backward_ms': 0.0,
+                    'backward_calls': 0,
+                    'flops': 0,
+                    'activation_bytes': 0,
+                    'param_bytes': self.param_bytes.get(record['name'], 0),
+                },
+            )
+            row['calls'] += 1
+            row['forward_ms'] += 1000 * (record['end'] - record['start'])
+            row['backward_ms'] += record['backward_ms']
+            row['backward_calls'] += record['backward_calls']
+            row['flops'] += record['flops']
+            row['activation_bytes'] += record['activation_bytes']
+        return list(rows.values())
+
+    def forward_ms(self):
+        '''Time of forward passes, summed over calls of outermost profiled modules'''
+        return sum(1000 * (record['end'] - record['start']) for record in self._records if record['outermost'])
+
+    def table(self):
+        '''Totals per module including submodules, fwd incl. % is the share of time of forward passes'''
+        rows = self.summary()
+        total = self.forward_ms() or 1
+        lines = [
+            f'{"module":<48}\t{"type":>20}\t{"calls":>6}\t{"fwd [ms]":>10}\t{"fwd incl. %":>11}\t'
+            f'{"bwd [ms]":>10}\t{"GFLOP":>8}\t{"act [MiB]":>10}\t{"par [MiB]":>9}'
+        ]
+        for row in rows:
+            backward = f'{row["backward_ms"]:10.2f}' if row['backward_calls'] else f'{"-":>10}'  # No measured leaves
+            lines.append(
+                f'{row["name"]:<48}\t{row["type"]:>20}\t{row["calls"]:6d}\t{row["forward_ms"]:10.2f}\t{100 * row["forward_ms"] / total:11.1f}\t'
+                f'{backward}\t{row["flops"] / 1e9:8.3f}\t{row["activation_bytes"] / 2 ** 20:10.2f}\t{row["param_bytes"] / 2 ** 20:9.3f}'
+            )
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        '''Trace events of all profiled calls, times in microseconds from the last reset'''
+        events = []
+        pid = os.getpid()
+        for record in self._records:
+            events.append(
+                {
+                    'name': record['name'],
+                    'cat': 'forward',
+                    'ph': 'X',
+                    'ts': 1e6 * (record['start'] - self._start),
+                    'dur': 1e6 * (record['end'] - record['start']),
+                    'pid': pid,
+                    'tid': record['thread'],
+                    'args': {'type': record['type'], 'flops': record['flops'], 'activation_bytes': record['activation_bytes']},
+                }
+            )
+        for call in self._backward:  # Leaf modules only
+            events.append(
+                {
+                    'name': call['name'],
+                    'cat': 'backward',
+                    'ph': 'X',
+                    'ts': 1e6 * (call['start'] - self._start),
+                    'dur': 1e6 * (call['end'] - call['start']),
+                    'pid': pid,
+                    'tid': call['thread'],
+                }
+            )
+        return {'traceEvents': events}
+
+    def finish(self, store=True, **format_kwargs):
+        '''Returns the table of profiled batches, stores reports to files formatted by format_kwargs and resets the records'''
+        result = self.table()
+        if store and self.json_file is not None:
+            with open(self.json_file.format(**format_kwargs), 'wt', encoding='utf-8') as f:
+                json.dump({'modules': self.summary()}, f, indent=2)
+        if store and self.trace_file is not None:
+            with open(self.trace_file.format(**format_kwargs), 'wt', encoding='utf-8') as f:
+                json.dump(self.chrome_trace(), f)
+        self.reset()
+        self.enabled = True
+        return result